@@ -0,0 +1,68 @@
+"""Benchmark corpora built from the JSON files shipped with the repository."""
+
+import io
+import itertools
+import json
+import pathlib
+import struct
+
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def load_json(name):
+    with open(ROOT / name) as stream:
+        return json.load(stream)
+
+
+def _dump_pipboy_string(stream, string):
+    data = string.encode()
+    stream.write(struct.pack("<I", len(data)))
+    stream.write(data)
+
+
+def _dump_pipboy_value(stream, item, ids):
+    if type(item) == list:
+        stream.write(struct.pack("<BII", 1, next(ids), len(item)))
+        for index, value in enumerate(item):
+            stream.write(struct.pack("<I", index))
+            _dump_pipboy_value(stream, value, ids)
+    elif type(item) == dict:
+        stream.write(struct.pack("<BII", 2, next(ids), len(item)))
+        for key, value in item.items():
+            # DemoMode.bin stores keys in lowercase
+            _dump_pipboy_string(stream, key.lower())
+            _dump_pipboy_value(stream, value, ids)
+    else:
+        stream.write(struct.pack("<BI", 0, next(ids)))
+        if type(item) == bool:
+            stream.write(struct.pack("<BB", 5, item))
+        elif type(item) == int:
+            if -(2**31) <= item < 2**31:
+                stream.write(struct.pack("<Bi", 0, item))
+            elif 0 <= item < 2**32:
+                stream.write(struct.pack("<BI", 1, item))
+            else:
+                stream.write(struct.pack("<Bq", 2, item))
+        elif type(item) == float:
+            stream.write(struct.pack("<Bd", 4, item))
+        else:
+            stream.write(struct.pack("<B", 6))
+            _dump_pipboy_string(stream, str(item))
+
+
+def pipboy_bin(item):
+    """Encode a JSON object in the format of DemoMode.bin."""
+    stream = io.BytesIO()
+    _dump_pipboy_value(stream, item, itertools.count())
+    return stream.getvalue()
+
+
+def scaled(item, factor):
+    """Repeat every inventory page `factor` times."""
+    result = dict(item)
+    result["Inventory"] = {
+        key: value * factor if type(value) == list else value
+        for key, value in item["Inventory"].items()
+    }
+    return result
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compare key canonicalisation of PipboyFormat against the former linear scan.
+
+Run from the repository root with `python benchmarks/pipboy_keys.py`.
+"""
+
+import io
+import timeit
+
+import corpus
+
+from pipboy.format import PipboyFormat
+
+
+def linear(key):
+    for x in PipboyFormat.spelling:
+        if x.lower() == key.lower():
+            return x
+    return key
+
+
+def main(factor=8, number=3):
+    data = corpus.pipboy_bin(corpus.scaled(corpus.load_json("DemoMode.json"), factor))
+    items = PipboyFormat.load(io.BytesIO(data))
+    keys = [key for _, value in items if type(value) == dict for key in value]
+    stored = [key.lower() for key in keys]
+    assert [linear(key) for key in stored] == keys
+    assert [PipboyFormat.canonical_key(key) for key in stored] == keys
+
+    linear_time = min(
+        timeit.repeat(lambda: [linear(k) for k in stored], number=number, repeat=3)
+    )
+    mapped_time = min(
+        timeit.repeat(
+            lambda: [PipboyFormat.canonical_key(k) for k in stored],
+            number=number,
+            repeat=3,
+        )
+    )
+    load_time = min(
+        timeit.repeat(
+            lambda: PipboyFormat.load(io.BytesIO(data)), number=number, repeat=3
+        )
+    )
+    print("{} bytes, {} entries, {} keys".format(len(data), len(items), len(keys)))
+    print("linear scan:    {:8.2f} ms".format(linear_time / number * 1000))
+    print("canonical map:  {:8.2f} ms".format(mapped_time / number * 1000))
+    print("speedup:        {:8.2f}x".format(linear_time / mapped_time))
+    print("PipboyFormat.load: {:8.2f} ms".format(load_time / number * 1000))
+
+
+if __name__ == "__main__":
+    main()
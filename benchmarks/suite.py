@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Benchmark suite for the codecs and the model.
+
+Run from the repository root, e.g.
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --compare before.json
+
+Every benchmark reports the best time of `--repeat` runs, the throughput in
+entries (and bytes where a payload is involved) per second and the peak
+memory allocated during one run as seen by tracemalloc.
+"""
+
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import corpus
+
+from pipboy.format import BuiltinFormat, PipboyFormat, TCPFormat
+from pipboy.mvc import Model
+
+
+FORMAT_VERSION = 1
+
+
+def corpora(factors):
+    """Yield (name, entries, channel 3 payload, DemoMode.bin payload)."""
+    sources = {"world": corpus.load_json("world.json")}
+    sources["demo"] = corpus.load_json("DemoMode.json")
+    for factor in factors:
+        sources["inventory-x%d" % factor] = corpus.scaled(sources["world"], factor)
+    for name, item in sources.items():
+        items = BuiltinFormat.load(item)
+        stream = io.BytesIO()
+        TCPFormat.dump(items, stream)
+        yield (name, items, stream.getvalue(), corpus.pipboy_bin(item))
+
+
+def cases(items, data, app):
+    """Yield (name, function, entries, bytes) for one corpus."""
+    model = Model()
+    model.load(items)
+    ids = [_id for _id, _ in model.dump(0, True)]
+    paths = [model.get_path(_id) for _id in ids]
+
+    def tcp_dump():
+        TCPFormat.dump(items, io.BytesIO())
+
+    yield ("TCPFormat.load", lambda: TCPFormat.load(io.BytesIO(data)), items, data)
+    yield ("TCPFormat.loads", lambda: TCPFormat.loads(data), items, data)
+    yield ("TCPFormat.dump", tcp_dump, items, data)
+    yield ("TCPFormat.dumps", lambda: TCPFormat.dumps(items), items, data)
+    yield ("PipboyFormat.load", lambda: PipboyFormat.load(io.BytesIO(app)), items, app)
+    yield ("Model.update", lambda: model.update(items), items, None)
+    yield ("Model.get_path", lambda: [model.get_path(i) for i in ids], ids, None)
+    yield ("Model.get_id", lambda: [model.get_id(p) for p in paths], paths, None)
+    yield ("Model.dump", lambda: model.dump(0, True), ids, None)
+
+
+def measure(function, repeat):
+    function()  # warm up
+    best = None
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (best, peak)
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=corpus.ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat, factors, selected=None):
+    results = {}
+    for name, items, data, app in corpora(factors):
+        for case, function, entries, payload in cases(items, data, app):
+            key = "{}/{}".format(name, case)
+            if selected and not any(s in key for s in selected):
+                continue
+            (seconds, peak) = measure(function, repeat)
+            result = {
+                "seconds": seconds,
+                "entries": len(entries),
+                "entries_per_second": len(entries) / seconds,
+                "peak_bytes": peak,
+            }
+            if payload is not None:
+                result["bytes"] = len(payload)
+                result["bytes_per_second"] = len(payload) / seconds
+            results[key] = result
+            report(key, result)
+    return {
+        "format": FORMAT_VERSION,
+        "python": sys.version,
+        "platform": platform.platform(),
+        "revision": revision(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def report(key, result, baseline=None):
+    line = "{:40} {:10.2f} ms {:12.0f} entries/s {:10.1f} KiB peak".format(
+        key,
+        result["seconds"] * 1000,
+        result["entries_per_second"],
+        result["peak_bytes"] / 1024,
+    )
+    if baseline is not None:
+        line += " {:6.2f}x".format(baseline["seconds"] / result["seconds"])
+    print(line)
+
+
+def compare(current, baseline):
+    print("\nspeedup against {}".format(baseline.get("revision")))
+    for key, result in current["results"].items():
+        if key in baseline["results"]:
+            report(key, result, baseline["results"][key])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, nargs="*", default=[4, 16])
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("select", nargs="*", help="only run matching benchmarks")
+    args = parser.parse_args()
+
+    current = run(args.repeat, args.scale, args.select)
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(current, stream, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as stream:
+            compare(current, json.load(stream))
+
+
+if __name__ == "__main__":
+    main()
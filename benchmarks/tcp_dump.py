@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Compare TCPFormat.dump and TCPFormat.dumps on world.json.
+
+Run from the repository root with `python benchmarks/tcp_dump.py`.
+"""
+
+import io
+import timeit
+
+import corpus
+
+from pipboy.format import BuiltinFormat, TCPFormat
+
+
+def dump(items):
+    stream = io.BytesIO()
+    TCPFormat.dump(items, stream)
+    return stream.getvalue()
+
+
+def main(number=20):
+    items = BuiltinFormat.load(corpus.load_json("world.json"))
+    assert dump(items) == TCPFormat.dumps(items)
+    stream_time = min(timeit.repeat(lambda: dump(items), number=number, repeat=5))
+    buffer_time = min(
+        timeit.repeat(lambda: TCPFormat.dumps(items), number=number, repeat=5)
+    )
+    print("{} entries, {} bytes".format(len(items), len(TCPFormat.dumps(items))))
+    print("TCPFormat.dump:  {:8.2f} ms".format(stream_time / number * 1000))
+    print("TCPFormat.dumps: {:8.2f} ms".format(buffer_time / number * 1000))
+    print("speedup:         {:8.2f}x".format(stream_time / buffer_time))
+
+
+if __name__ == "__main__":
+    main()
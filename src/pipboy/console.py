@@ -10,8 +10,8 @@ import threading
 from typing import Optional
 
 from .format import BuiltinFormat, PipboyFormat, TCPFormat
-from .mvc import Model, View
-from .tcp import TCPClient, TCPServer
+from .mvc import Dispatcher, Model, View
+from .tcp import AsyncTCPServer, TCPClient, TCPServer
 from .udp import UDPClient, UDPServer
 
 
@@ -85,6 +85,33 @@ class Console(cmd.Cmd):
             self.view.should_spam = False
             print("Turned output off.")
 
+    def do_dispatch(self, line):
+        """
+        `dispatch <1/0>` - If updates are delivered to listeners on separate threads.
+        Without argument shows queue statistics.
+        """
+        line = line.strip().lower()
+        if not line:
+            if not self.model.dispatcher:
+                print("Updates are delivered synchronously.")
+                return
+            for name, stats in sorted(self.model.dispatcher.stats().items()):
+                print(
+                    "{name} {listener}: depth {depth} (max {max_depth}), "
+                    "{delivered}/{received} delivered in {batches} batches, "
+                    "{merged} merged, latency {mean_latency:.4f}s "
+                    "(max {max_latency:.4f}s)".format(name=name, **stats)
+                )
+        elif line in ["1", "y", "yes", "true"]:
+            if not self.model.dispatcher:
+                self.model.dispatcher = Dispatcher()
+            print("Turned asynchronous dispatch on.")
+        else:
+            if self.model.dispatcher:
+                self.model.dispatcher.stop()
+                self.model.dispatcher = None
+            print("Turned asynchronous dispatch off.")
+
     __discover = None
     # List of Fallout apps. Can be busy.
 
@@ -231,7 +258,7 @@ class Console(cmd.Cmd):
         """
         with open(line, "rb") as stream:
             try:
-                self.model.load(TCPFormat.load(stream))
+                self.model.load(TCPFormat.loads(stream.read()))
             except Exception as e:
                 self.logger.error(e)
                 print(("Not in TCPFormat - {}".format(line)))
@@ -241,16 +268,19 @@ class Console(cmd.Cmd):
         `save <file>` - saves database to file in the format of Channel 3
         """
         with open(line, "wb") as stream:
-            TCPFormat.dump(self.model.dump(0, True), stream)
+            stream.write(TCPFormat.dumps(self.model.snapshot().dump(0, True)))
 
     def do_savejson(self, line):
         """
         `savejson <file>` - saves database to JSON-file
         """
         with open(line, "w") as stream:
-            json.dump(
-                BuiltinFormat.dump_model(self.model), stream, indent=4, sort_keys=True
-            )
+            try:
+                BuiltinFormat.dump_json(
+                    self.model.snapshot(), stream, indent=4, sort_keys=True
+                )
+            except ValueError as e:
+                self.logger.error(e)
 
     def do_loadapp(self, line):
         """
@@ -268,10 +298,14 @@ class Console(cmd.Cmd):
 
     def do_start(self, line):
         """
-        `start` - starts server so app can connect
+        `start [async]` - starts server so app can connect, async serves all apps
+        from one thread
         """
         if self.tcp_server is None:
-            self.tcp_server = ServerThread(self.model, TCPServer)
+            if line.strip().lower() == "async":
+                self.tcp_server = ServerThread(self.model, AsyncTCPServer)
+            else:
+                self.tcp_server = ServerThread(self.model, TCPServer)
             self.tcp_server.start()
         else:
             self.logger.warn("TCP server already running.")
@@ -300,6 +334,17 @@ class Console(cmd.Cmd):
         else:
             self.logger.info("TCP already stopped.")
 
+    def do_gc(self, line):
+        """
+        `gc` - removes database entries no longer reachable from $
+        """
+        (entries, size) = self.model.gc()
+        print(
+            "Removed {entries} entries ({size} bytes), {total} in total.".format(
+                entries=entries, size=size, total=self.model.collected["entries"]
+            )
+        )
+
     def do_threads(self, line):
         """
         `threads` - show running threads
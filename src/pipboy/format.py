@@ -1,12 +1,73 @@
 #!/usr/bin/env python
 
+import array
+import collections
+import concurrent.futures
+import itertools
+import json
 import logging
 import struct
+import sys
+import zlib
+
+from typing import Dict, List, Set, Tuple
+
+
+class DictUpdate(dict):
+    """
+    Dict entry of channel 3, the keys to insert and the references in
+    `removed` to delete from the previous value of the same id.
+    """
+
+    def __init__(self, inserted=(), removed=()):
+        super(DictUpdate, self).__init__(inserted)
+        self.removed = list(removed)
+
+    def __repr__(self):
+        return "DictUpdate(%s, removed=%s)" % (dict.__repr__(self), self.removed)
+
+    def merge(self, previous):
+        """Apply to previous, returns the resulting plain dict."""
+        if type(previous) != dict:
+            return dict(self)
+        removed = set(self.removed)
+        result = {k: v for k, v in previous.items() if v not in removed}
+        result.update(self)
+        return result
+
+    @staticmethod
+    def diff(previous, value):
+        """Minimal update turning the dict previous into value."""
+        inserted = {k: v for k, v in value.items() if previous.get(k) != v}
+        removed = [v for k, v in previous.items() if k not in value]
+        if removed:
+            # merge removes by reference, keys sharing one must be re-inserted
+            gone = set(removed)
+            inserted.update((k, v) for k, v in value.items() if v in gone)
+        return DictUpdate(inserted, removed)
 
 
 class TCPFormat(object):
     logger = logging.getLogger("pipboy.TCPFormat")
 
+    # array typecode of an uint32_t reference
+    __refs = "I" if array.array("I").itemsize == 4 else "L"
+
+    @staticmethod
+    def __refs_from(data):
+        refs = array.array(TCPFormat.__refs)
+        refs.frombytes(data)
+        if sys.byteorder == "big":
+            refs.byteswap()
+        return refs.tolist()
+
+    @staticmethod
+    def __refs_to(value):
+        refs = array.array(TCPFormat.__refs, value)
+        if sys.byteorder == "big":
+            refs.byteswap()
+        return refs
+
     @staticmethod
     def __load_bool(stream):
         (val,) = struct.unpack("<B", stream.read(1))
@@ -30,12 +91,11 @@ class TCPFormat(object):
 
     @staticmethod
     def __load_list(stream):
-        value = []
         (_count,) = struct.unpack("<H", stream.read(2))
-        for _i in range(0, _count):
-            (tmp,) = struct.unpack("<I", stream.read(4))
-            value.append(tmp)
-        return value
+        data = stream.read(4 * _count)
+        if len(data) != 4 * _count:
+            raise struct.error("unpack requires a buffer of %d bytes" % (4 * _count))
+        return TCPFormat.__refs_from(data)
 
     @staticmethod
     def __load_dict(stream):
@@ -45,10 +105,7 @@ class TCPFormat(object):
             (ref,) = struct.unpack("<I", stream.read(4))
             attribute = TCPFormat.__load_cstr(stream)
             value[attribute] = ref
-        (_count,) = struct.unpack("<H", stream.read(2))
-        for _i in range(0, _count):
-            (ref,) = struct.unpack("<I", stream.read(4))
-        return value
+        return DictUpdate(value, TCPFormat.__load_list(stream))
 
     @staticmethod
     def load(stream):
@@ -83,6 +140,98 @@ class TCPFormat(object):
             items.append([_id, value])
         return items
 
+    __head = struct.Struct("<BI")
+    __bool = struct.Struct("<B")
+    __count = struct.Struct("<H")
+    __ref = struct.Struct("<I")
+    __native = {
+        1: struct.Struct("<b"),
+        2: struct.Struct("<B"),
+        3: struct.Struct("<i"),
+        4: struct.Struct("<I"),
+        5: struct.Struct("<f"),
+    }
+
+    @staticmethod
+    def __unpack_cstr(data, view, offset):
+        end = data.find(b"\x00", offset)
+        if end < 0:
+            raise struct.error("unterminated string at offset %d" % offset)
+        return (str(view[offset:end], "utf-8"), end + 1)
+
+    @staticmethod
+    def __unpack_list(data, view, offset):
+        (_count,) = TCPFormat.__count.unpack_from(data, offset)
+        offset += 2
+        end = offset + 4 * _count
+        if end > len(data):
+            raise struct.error("unpack requires a buffer of %d bytes" % (4 * _count))
+        return (TCPFormat.__refs_from(view[offset:end]), end)
+
+    @staticmethod
+    def __unpack_dict(data, view, offset):
+        value = {}
+        (_count,) = TCPFormat.__count.unpack_from(data, offset)
+        offset += 2
+        for _i in range(0, _count):
+            (ref,) = TCPFormat.__ref.unpack_from(data, offset)
+            (attribute, offset) = TCPFormat.__unpack_cstr(data, view, offset + 4)
+            value[attribute] = ref
+        (removed, offset) = TCPFormat.__unpack_list(data, view, offset)
+        return (DictUpdate(value, removed), offset)
+
+    @staticmethod
+    def _unpack_entry(data, view, offset):
+        """Decode the entry starting at ``offset`` of ``data``.
+
+        Returns ``(_id, value, offset)`` with ``offset`` pointing behind the
+        entry, or ``None`` for an unknown type. Raises ``struct.error`` if
+        ``data`` ends within the entry.
+        """
+        (typ, _id) = TCPFormat.__head.unpack_from(data, offset)
+        offset += 5
+        if typ == 0:  # confirmed bool
+            (value,) = TCPFormat.__bool.unpack_from(data, offset)
+            value = [False, True][value]
+            offset += 1
+        elif typ in TCPFormat.__native:
+            unpack = TCPFormat.__native[typ]
+            (value,) = unpack.unpack_from(data, offset)
+            offset += unpack.size
+        elif typ == 6:
+            (value, offset) = TCPFormat.__unpack_cstr(data, view, offset)
+        elif typ == 7:
+            (value, offset) = TCPFormat.__unpack_list(data, view, offset)
+        elif typ == 8:
+            (value, offset) = TCPFormat.__unpack_dict(data, view, offset)
+        else:
+            TCPFormat.logger.error("Unknown Typ %d" % typ)
+            return None
+        return (_id, value, offset)
+
+    @staticmethod
+    def loads(data):
+        """Decode a complete channel 3 payload held in memory.
+
+        Same result as :meth:`load`, but works with an offset into ``data``
+        instead of reading from a stream. ``data`` may be ``bytes``,
+        ``bytearray`` or a ``memoryview``.
+        """
+        if isinstance(data, memoryview):
+            # bytes.find() is needed for the string terminators
+            whole = isinstance(data.obj, bytes) and data.nbytes == len(data.obj)
+            data = data.obj if whole else data.tobytes()
+        view = memoryview(data)
+        items = []
+        offset = 0
+        while offset < len(data):
+            entry = TCPFormat._unpack_entry(data, view, offset)
+            if entry is None:
+                break
+            (_id, value, offset) = entry
+            items.append([_id, value])
+        return items
+
     @staticmethod
     def __dump_cstr(stream, string):
         stream.write(string.encode())
@@ -132,17 +281,17 @@ class TCPFormat(object):
     def __dump_list(stream, _id, item):
         TCPFormat.__dump_head(stream, _id, 7)
         stream.write(struct.pack("<H", len(item)))
-        for val in item:
-            stream.write(struct.pack("<I", val))
+        stream.write(TCPFormat.__refs_to(item))
 
     @staticmethod
     def __dump_dict(stream, _id, item):
         TCPFormat.__dump_head(stream, _id, 8)
-        stream.write(struct.pack("<H", len(item)))
-        for key, val in list(item.items()):
-            stream.write(struct.pack("<I", val))
-            TCPFormat.__dump_cstr(stream, key)
-        stream.write(struct.pack("<H", 0))
+        keys = [key.encode() for key in item]
+        fmt = "<H%sH" % "".join("I%dsx" % len(key) for key in keys)
+        refs = itertools.chain.from_iterable(zip(item.values(), keys))
+        removed = getattr(item, "removed", ())
+        stream.write(struct.pack(fmt, len(item), *refs, len(removed)))
+        stream.write(TCPFormat.__refs_to(removed))
 
     @staticmethod
     def dump(items, stream):
@@ -157,9 +306,152 @@ class TCPFormat(object):
                 TCPFormat.__dump_str(stream, _id, value)
             elif type(value) == list:
                 TCPFormat.__dump_list(stream, _id, value)
-            elif type(value) == dict:
+            elif type(value) == dict or type(value) == DictUpdate:
                 TCPFormat.__dump_dict(stream, _id, value)
 
+    __entry = {
+        0: struct.Struct("<BIB"),
+        1: struct.Struct("<BIb"),
+        2: struct.Struct("<BIB"),
+        3: struct.Struct("<BIi"),
+        4: struct.Struct("<BII"),
+        5: struct.Struct("<BIf"),
+    }
+
+    @staticmethod
+    def __measure(items, dicts):
+        """Encoded size of ``items``, fills ``dicts`` with the dict layouts."""
+        size = 0
+        for _id, value in items:
+            typ = type(value)
+            if typ is bool:
+                size += 6
+            elif typ is int:
+                size += 6 if -128 <= value <= 127 else 9
+            elif typ is float:
+                size += 9
+            elif typ is str:
+                size += 6 + (len(value) if value.isascii() else len(value.encode()))
+            elif typ is list:
+                size += 7 + 4 * len(value)
+            elif typ is dict or typ is DictUpdate:
+                keys = tuple(value)
+                if keys not in dicts:
+                    encoded = [key.encode() for key in keys]
+                    fmt = "".join("I%dsx" % len(key) for key in encoded)
+                    dicts[keys] = (struct.Struct("<BIH%sH" % fmt), encoded)
+                size += dicts[keys][0].size
+                if typ is DictUpdate:
+                    size += 4 * len(value.removed)
+        return size
+
+    @staticmethod
+    def size(items):
+        """Number of bytes :meth:`dumps` and :meth:`dump` produce for ``items``."""
+        return TCPFormat.__measure(items, {})
+
+    @staticmethod
+    def dumps(items):
+        """Encode ``items`` into a single preallocated ``bytearray``.
+
+        Byte-for-byte the same output as :meth:`dump`. The exact size is
+        computed first, then every entry is written with one
+        ``struct.pack_into`` into the buffer, which can be passed directly to
+        ``send``. Layouts of strings, lists and dicts are shared between
+        entries of the same shape.
+        """
+        fixed = TCPFormat.__entry
+        strings: Dict[int, struct.Struct] = {}
+        lists: Dict[int, struct.Struct] = {}
+        dicts: Dict[tuple, Tuple[struct.Struct, List[bytes]]] = {}
+        refs_only: Dict[int, struct.Struct] = {}
+        size = TCPFormat.__measure(items, dicts)
+        buffer = bytearray(size)
+        offset = 0
+        for _id, value in items:
+            typ = type(value)
+            if typ is bool:
+                pack = fixed[0]
+                pack.pack_into(buffer, offset, 0, _id, 1 if value else 0)
+            elif typ is int:
+                if value < 0:
+                    code = 3 if value < -128 else 1
+                else:
+                    code = 4 if value > 127 else 2
+                pack = fixed[code]
+                pack.pack_into(buffer, offset, code, _id, value)
+            elif typ is float:
+                pack = fixed[5]
+                pack.pack_into(buffer, offset, 5, _id, value)
+            elif typ is str:
+                value = value.encode()
+                pack = strings.get(len(value)) or strings.setdefault(
+                    len(value), struct.Struct("<BI%dsx" % len(value))
+                )
+                pack.pack_into(buffer, offset, 6, _id, value)
+            elif typ is list:
+                pack = lists.get(len(value)) or lists.setdefault(
+                    len(value), struct.Struct("<BIH%dI" % len(value))
+                )
+                pack.pack_into(buffer, offset, 7, _id, len(value), *value)
+            elif typ is dict or typ is DictUpdate:
+                (pack, encoded) = dicts[tuple(value)]
+                refs = itertools.chain.from_iterable(zip(value.values(), encoded))
+                removed = value.removed if typ is DictUpdate else ()
+                pack.pack_into(buffer, offset, 8, _id, len(value), *refs, len(removed))
+                if removed:
+                    offset += pack.size
+                    pack = refs_only.get(len(removed)) or refs_only.setdefault(
+                        len(removed), struct.Struct("<%dI" % len(removed))
+                    )
+                    pack.pack_into(buffer, offset, *removed)
+            else:
+                continue
+            offset += pack.size
+        return buffer
+
+
+class TCPDecoder(object):
+    """Incremental decoder for a channel 3 payload that is still arriving.
+
+    Chunks are passed to :meth:`feed` as they are received, :meth:`entries`
+    returns every entry that is complete by now and keeps the trailing
+    partial entry for the next call.
+    """
+
+    logger = logging.getLogger("pipboy.TCPDecoder")
+
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__failed = False
+
+    @property
+    def pending(self):
+        return len(self.__buffer)
+
+    def feed(self, chunk):
+        if not self.__failed:
+            self.__buffer += chunk
+
+    def entries(self):
+        items = []
+        data = self.__buffer
+        offset = 0
+        with memoryview(data) as view:
+            while offset < len(data):
+                try:
+                    entry = TCPFormat._unpack_entry(data, view, offset)
+                except struct.error:
+                    break  # incomplete, wait for more data
+                if entry is None:
+                    self.__failed = True
+                    offset = len(data)
+                    break
+                (_id, value, offset) = entry
+                items.append([_id, value])
+        del data[:offset]
+        return items
+
 
 class PipboyFormat(object):
     logger = logging.getLogger("pipboy.PipboyFormat")
@@ -294,6 +586,13 @@ class PipboyFormat(object):
         "workshopData",
     ]
 
+    # lowercase -> canonical spelling, keys and values are interned
+    canonical = {sys.intern(x.lower()): sys.intern(x) for x in spelling}
+
+    @staticmethod
+    def canonical_key(key):
+        return PipboyFormat.canonical.get(key.lower()) or sys.intern(key)
+
     @staticmethod
     def __load_string(stream):
         (length,) = struct.unpack("<I", stream.read(4))
@@ -301,12 +600,8 @@ class PipboyFormat(object):
 
     @staticmethod
     def __load_key(stream):
-        key = PipboyFormat.__load_string(stream)
-        for x in PipboyFormat.spelling:
-            if x.lower() == key.lower():
-                key = x
-                break
-        return key
+        key = PipboyFormat.__load_string(stream).decode()
+        return PipboyFormat.canonical_key(key)
 
     @staticmethod
     def __load_primitive(stream):
@@ -330,91 +625,76 @@ class PipboyFormat(object):
             PipboyFormat.logger.error("Unknown Primitive Typ %d" % typ)
         return value
 
-    @staticmethod
-    def __load_array(stream):
-        children = []
-        (_count,) = struct.unpack("<I", stream.read(4))
-        value = [None] * _count
-        for _i in range(0, _count):
-            (_index,) = struct.unpack("<I", stream.read(4))
-            (_id, child) = PipboyFormat.__load_value(stream)
-            value[_index] = _id
-            children += child
-        return (value, children)
-
-    @staticmethod
-    def __load_object(stream):
-        children = []
-        (_count,) = struct.unpack("<I", stream.read(4))
-        value = {}
-        for _i in range(0, _count):
-            key = PipboyFormat.__load_key(stream)
-            (_id, child) = PipboyFormat.__load_value(stream)
-            value[key] = _id
-            children += child
-        return (value, children)
-
-    @staticmethod
-    def __load_value(stream):
-        (typ, _id) = struct.unpack("<BI", stream.read(5))
-        if typ == 0:
-            value = PipboyFormat.__load_primitive(stream)
-            children = []
-        elif typ == 1:
-            (value, children) = PipboyFormat.__load_array(stream)
-        elif typ == 2:
-            (value, children) = PipboyFormat.__load_object(stream)
-        else:
-            PipboyFormat.logger.error("Unknown Typ %d" % typ)
-        children.append([_id, value])
-        return (_id, children)
+    __head = struct.Struct("<BI")
+    __count = struct.Struct("<I")
 
     @staticmethod
     def load(stream):
-        (_, result) = PipboyFormat.__load_value(stream)
+        head = PipboyFormat.__head
+        count = PipboyFormat.__count
+        result = []
+        stack: List[list] = []  # open arrays and objects as [_id, value, remaining]
+        while True:
+            if stack:
+                parent = stack[-1]
+                if type(parent[1]) == list:
+                    (slot,) = count.unpack(stream.read(4))
+                else:
+                    slot = PipboyFormat.__load_key(stream)
+                parent[2] -= 1
+            (typ, _id) = head.unpack(stream.read(5))
+            if stack:
+                parent[1][slot] = _id
+            if typ == 0:
+                result.append([_id, PipboyFormat.__load_primitive(stream)])
+            elif typ == 1:
+                (_count,) = count.unpack(stream.read(4))
+                stack.append([_id, [None] * _count, _count])
+            elif typ == 2:
+                (_count,) = count.unpack(stream.read(4))
+                stack.append([_id, {}, _count])
+            else:
+                PipboyFormat.logger.error("Unknown Typ %d" % typ)
+                break
+            while stack and stack[-1][2] == 0:
+                (_id, value, _) = stack.pop()
+                result.append([_id, value])
+            if not stack:
+                break
         return result
 
 
 class BuiltinFormat(object):
     logger = logging.getLogger("pipboy.BuiltinFormat")
 
-    @staticmethod
-    def __load_list(item, _id):
-        value = []
-        children = []
-        next_id = _id + 1
-        for subitem in item:
-            value.append(next_id)
-            (next_id, child) = BuiltinFormat.__load(subitem, next_id)
-            children += child
-        children.append([_id, value])
-        return (next_id, children)
-
-    @staticmethod
-    def __load_dict(item, _id):
-        value = {}
-        children = []
-        next_id = _id + 1
-        for name, subitem in list(item.items()):
-            value[name] = next_id
-            (next_id, child) = BuiltinFormat.__load(subitem, next_id)
-            children += child
-        children.append([_id, value])
-        return (next_id, children)
-
-    @staticmethod
-    def __load(item, _id):
-        if type(item) == dict:
-            return BuiltinFormat.__load_dict(item, _id)
-        elif type(item) == list:
-            return BuiltinFormat.__load_list(item, _id)
-        else:
-            return (_id + 1, [[_id, item]])
-
     @staticmethod
     def load(item):
-        (_, result) = BuiltinFormat.__load(item, 0)
-        return result
+        result = []
+        stack: List[tuple] = []  # open lists and dicts as (_id, value, children)
+        next_id = 0
+        while True:
+            if type(item) == dict:
+                stack.append((next_id, {}, iter(list(item.items()))))
+            elif type(item) == list:
+                stack.append((next_id, [], enumerate(item)))
+            else:
+                result.append([next_id, item])
+            next_id += 1
+            while stack:
+                (_id, value, children) = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    result.append([_id, value])
+                    continue
+                (name, item) = child
+                if type(value) == list:
+                    value.append(next_id)
+                else:
+                    value[name] = next_id
+                break
+            else:
+                return result
 
     @staticmethod
     def __dump_model(model, _id):
@@ -430,3 +710,181 @@ class BuiltinFormat(object):
     @staticmethod
     def dump_model(model):
         return BuiltinFormat.__dump_model(model, 0)
+
+    @staticmethod
+    def dump_json(model, stream, indent=4, sort_keys=True):
+        """Write ``model`` as JSON to ``stream`` while walking it by id.
+
+        The nested structure of :meth:`dump_model` is never built, the output
+        is the same as ``json.dump`` of it with ``indent`` and ``sort_keys``.
+        Raises ``ValueError`` if a container contains itself.
+        """
+        encode = json.JSONEncoder().encode
+        write = stream.write
+        if indent is None:
+            (newline, step, separator) = ("", "", ", ")
+        else:
+            (newline, step, separator) = ("\n", " " * indent, ",")
+        # open containers as [children, indentation, closing, first, id]
+        stack: List[list] = []
+        opened: Set[int] = set()  # ids of the open containers
+        _id = 0
+        while True:
+            if _id in opened:
+                raise ValueError("Cyclic reference to id %d" % _id)
+            item = model.get_item(_id)
+            outer = newline + step * len(stack)
+            if type(item) == list and item:
+                write("[")
+                stack.append([iter(item), outer + step, outer + "]", True, _id])
+                opened.add(_id)
+            elif type(item) == dict and item:
+                write("{")
+                keys = sorted(item) if sort_keys else list(item)
+                children = [(encode(k) + ": ", item[k]) for k in keys]
+                stack.append([iter(children), outer + step, outer + "}", True, _id])
+                opened.add(_id)
+            else:
+                write(encode(item))
+            while stack:
+                frame = stack[-1]
+                child = next(frame[0], None)
+                if child is None:
+                    stack.pop()
+                    opened.discard(frame[4])
+                    write(frame[2])
+                    continue
+                write(frame[1] if frame[3] else separator + frame[1])
+                frame[3] = False
+                if type(child) == tuple:
+                    (key, _id) = child
+                    write(key)
+                else:
+                    _id = child
+                break
+            else:
+                return
+
+
+Extent = collections.namedtuple("Extent", ["x", "y"])
+
+
+class LocalMap(object):
+    """Local map as sent on channel 4.
+
+    The header is parsed once, ``pixels`` is a ``memoryview`` into the
+    received data (``height`` rows of ``width`` grayscale bytes). NumPy can
+    wrap it without a copy through ``__array_interface__``.
+    """
+
+    logger = logging.getLogger("pipboy.LocalMap")
+
+    __header = struct.Struct("<II6f")
+    # helpers off the network thread
+    __executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="LocalMap"
+    )
+
+    tile_size = 32
+
+    def __init__(self, data):
+        (width, height, *extents) = LocalMap.__header.unpack_from(data)
+        size = LocalMap.__header.size + width * height
+        if len(data) < size:
+            raise ValueError(
+                "Map of {}x{} needs {} bytes, got {}".format(
+                    width, height, size, len(data)
+                )
+            )
+        self.data = data
+        self.width = width
+        self.height = height
+        self.nw = Extent(*extents[0:2])
+        self.ne = Extent(*extents[2:4])
+        self.sw = Extent(*extents[4:6])
+        start = LocalMap.__header.size
+        self.pixels = memoryview(data)[start:size]
+        self.checksum = zlib.crc32(self.pixels)
+        self.changed = self.tiles()
+
+    @property
+    def __array_interface__(self):
+        return {
+            "shape": (self.height, self.width),
+            "typestr": "|u1",
+            "data": self.pixels,
+            "version": 3,
+        }
+
+    def row(self, y):
+        start = y * self.width
+        end = start + self.width
+        return self.pixels[start:end]
+
+    def tiles(self):
+        """All tiles as (x, y) in units of `tile_size`."""
+        size = self.tile_size
+        return [
+            (x, y)
+            for y in range(0, (self.height + size - 1) // size)
+            for x in range(0, (self.width + size - 1) // size)
+        ]
+
+    def diff(self, other):
+        """Tiles that differ from `other`, all tiles if the extents differ."""
+        if (
+            other is None
+            or (self.width, self.height) != (other.width, other.height)
+            or (self.nw, self.ne, self.sw) != (other.nw, other.ne, other.sw)
+        ):
+            return self.tiles()
+        # differing checksums tell a change quickly, equal ones prove nothing
+        if self.checksum == other.checksum and self.pixels == other.pixels:
+            return []
+        size = self.tile_size
+        changed = set()
+        for y in range(0, self.height):
+            row = self.row(y)
+            previous = other.row(y)
+            if row == previous:
+                continue
+            for x in range(0, self.width, size):
+                end = x + size
+                if row[x:end] != previous[x:end]:
+                    changed.add((x // size, y // size))
+        return sorted(changed, key=lambda tile: (tile[1], tile[0]))
+
+    def downsample(self, factor):
+        """Keep every `factor`-th pixel of every `factor`-th row."""
+        rows = [self.row(y)[::factor].tobytes() for y in range(0, self.height, factor)]
+        width = len(rows[0]) if rows else 0
+        header = LocalMap.__header.pack(width, len(rows), *self.nw, *self.ne, *self.sw)
+        return LocalMap(header + b"".join(rows))
+
+    @staticmethod
+    def __png_chunk(typ, data):
+        chunk = typ + data
+        return (
+            struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+        )
+
+    def to_png(self):
+        """Encode as 8-bit grayscale PNG."""
+        raw = b"".join(b"\x00" + self.row(y) for y in range(0, self.height))
+        return b"".join(
+            [
+                b"\x89PNG\r\n\x1a\n",
+                LocalMap.__png_chunk(
+                    b"IHDR",
+                    struct.pack(">IIBBBBB", self.width, self.height, 8, 0, 0, 0, 0),
+                ),
+                LocalMap.__png_chunk(b"IDAT", zlib.compress(raw)),
+                LocalMap.__png_chunk(b"IEND", b""),
+            ]
+        )
+
+    def downsample_async(self, factor):
+        return LocalMap.__executor.submit(self.downsample, factor)
+
+    def to_png_async(self):
+        return LocalMap.__executor.submit(self.to_png)
@@ -1,14 +1,408 @@
 #!/usr/bin/env python
 
+import array
+import collections
+import contextlib
+import functools
+import itertools
 import logging
 import re
+import sys
+import threading
+import time
 
-from .format import BuiltinFormat
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from .format import BuiltinFormat, DictUpdate
+
+
+class DispatchQueue(object):
+    """
+    Pending changes of one `update` listener, delivered by its own thread.
+    Ids changed again before the listener got them are merged, the listener
+    reads the latest value from the model anyway.
+    """
+
+    logger = logging.getLogger("pipboy.DispatchQueue")
+
+    __counter = itertools.count(1)
+
+    def __init__(self, function):
+        self.function = function
+        self.name = "Dispatch-%d" % next(DispatchQueue.__counter)
+        self.__pending = {}  # ids in order of their first change
+        self.__since = 0.0  # when the oldest pending id was put
+        self.__running = True
+        self.__condition = threading.Condition()
+        self.received = 0
+        self.merged = 0
+        self.delivered = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, changed):
+        with self.__condition:
+            if not self.__pending:
+                self.__since = time.monotonic()
+            for _id in changed:
+                if _id in self.__pending:
+                    self.merged += 1
+                else:
+                    self.__pending[_id] = None
+            self.received += len(changed)
+            self.max_depth = max(self.max_depth, len(self.__pending))
+            self.__condition.notify()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+
+    def run(self):
+        while True:
+            with self.__condition:
+                while self.__running and not self.__pending:
+                    self.__condition.wait()
+                if not self.__pending:
+                    return
+                batch = list(self.__pending)
+                self.__pending.clear()
+                latency = time.monotonic() - self.__since
+            self.batches += 1
+            self.delivered += len(batch)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            try:
+                self.function(batch)
+            except Exception:
+                self.logger.exception("Listener {} failed".format(self.function))
+
+    def stats(self):
+        with self.__condition:
+            depth = len(self.__pending)
+        return {
+            "listener": getattr(self.function, "__qualname__", repr(self.function)),
+            "depth": depth,
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "merged": self.merged,
+            "delivered": self.delivered,
+            "batches": self.batches,
+            "mean_latency": self.total_latency / self.batches if self.batches else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+class Dispatcher(object):
+    """
+    Opt-in asynchronous delivery of `update` change sets, see
+    `Model.dispatcher`. Every listener has its own `DispatchQueue`, so a
+    slow listener neither stalls the model nor the other listeners.
+    """
+
+    logger = logging.getLogger("pipboy.Dispatcher")
+
+    def __init__(self):
+        self.__queues = {}
+        self.__lock = threading.Lock()
+        self.__stopped = False
+
+    def dispatch(self, listeners, changed):
+        for func in listeners:
+            with self.__lock:
+                queue = self.__queues.get(func)
+                if queue is None and not self.__stopped:
+                    queue = self.__queues[func] = DispatchQueue(func)
+            if queue:
+                queue.put(changed)
+            else:
+                func(changed)
+
+    def remove(self, function):
+        with self.__lock:
+            queue = self.__queues.pop(function, None)
+        if queue:
+            queue.stop()
+
+    def stop(self):
+        with self.__lock:
+            self.__stopped = True
+            queues = list(self.__queues.values())
+            self.__queues.clear()
+        for queue in queues:
+            queue.stop()
+
+    def stats(self):
+        with self.__lock:
+            queues = list(self.__queues.values())
+        return {queue.name: queue.stats() for queue in queues}
+
+
+class PathTrie(object):
+    """
+    Values stored under path patterns like `$.Map.Local.Player` or
+    `$.Inventory.*[*]`. Segments are compared case-insensitive, `*` matches
+    any key or index.
+    """
+
+    __segment = re.compile(r"\.([a-zA-Z0-9]+|\*)|\[([0-9]+|\*)\]")
+
+    def __init__(self, patterns=()):
+        # node is (children by segment, values)
+        self.__root: Tuple[dict, list] = ({}, [])
+        self.__count = 0
+        for pattern in patterns:
+            self.add(pattern, pattern)
+
+    def __len__(self):
+        return self.__count
+
+    @staticmethod
+    def segments(pattern):
+        if not pattern.startswith("$"):
+            raise ValueError("Path must start with $: %s" % pattern)
+        segments = []
+        pos = 1
+        while pos < len(pattern):
+            match = PathTrie.__segment.match(pattern, pos)
+            if not match:
+                raise ValueError("Malformed path: %s" % pattern)
+            (key, index) = match.groups()
+            if key == "*" or index == "*":
+                segments.append("*")
+            elif key:
+                segments.append("." + key.lower())
+            else:
+                segments.append("[%d]" % int(index))
+            pos = match.end()
+        return segments
+
+    def add(self, pattern, value):
+        node = self.__root
+        for segment in self.segments(pattern):
+            node = node[0].setdefault(segment, ({}, []))
+        node[1].append(value)
+        self.__count += 1
+
+    def remove(self, pattern, value):
+        nodes = [self.__root]
+        segments = self.segments(pattern)
+        for segment in segments:
+            node = nodes[-1][0].get(segment)
+            if node is None:
+                raise ValueError("Not subscribed: %s" % pattern)
+            nodes.append(node)
+        nodes[-1][1].remove(value)
+        self.__count -= 1
+        for depth in range(len(segments), 0, -1):
+            if nodes[depth][0] or nodes[depth][1]:
+                break
+            del nodes[depth - 1][0][segments[depth - 1]]
+
+    def match(self, segments, prefix=True):
+        """
+        Values whose pattern matches `segments` (as from `Model.get_segments`),
+        or a prefix of them if `prefix` is set.
+        """
+        result = []
+        nodes = [self.__root]
+        for segment in segments:
+            if prefix:
+                for node in nodes:
+                    result += node[1]
+            if segment[0] == ".":
+                segment = segment.lower()
+            children = []
+            for node in nodes:
+                child = node[0].get(segment)
+                if child:
+                    children.append(child)
+                child = node[0].get("*")
+                if child:
+                    children.append(child)
+            nodes = children
+            if not nodes:
+                return result
+        for node in nodes:
+            result += node[1]
+        return result
+
+
+class Snapshot(object):
+    """
+    Immutable view of a `Model` at one version, see `Model.snapshot`. The
+    storage is split into pages, the next version copies only the pages that
+    changed and shares the others with the snapshots before it.
+    """
+
+    logger = logging.getLogger("pipboy.Snapshot")
+
+    # ids per page as a power of 2
+    page_bits = 10
+    # value slot of ids that are not stored
+    missing = object()
+    # parent of ids that are not linked, and of `$`
+    unlinked = 0xFFFFFFFF
+
+    def __init__(self, version=0, size=0, values=(), parents=(), names=()):
+        self.version = version
+        self.__size = size
+        self.__values = values  # pages of values, parents and names by id
+        self.__parents = parents
+        self.__names = names
+        self.__paths = {0: "$"}
+        self.__keys = {}
+
+    def derive(self, version, values, parents, names, dirty):
+        """
+        Snapshot of the flat storage of a model.
+        :param dirty: pages changed since this snapshot, None if every page
+            has to be copied
+        """
+        bits = Snapshot.page_bits
+        count = (len(values) + (1 << bits) - 1) >> bits
+        pages = []
+        for own, flat in (
+            (self.__values, values),
+            (self.__parents, parents),
+            (self.__names, names),
+        ):
+            result = list(own[:count]) if dirty is not None else []
+            result.extend([None] * (count - len(result)))
+            for page in range(0, count):
+                if dirty is None or page in dirty or result[page] is None:
+                    start = page << bits
+                    end = start + (1 << bits)
+                    result[page] = flat[start:end]
+                    if type(result[page]) == list:
+                        result[page] = tuple(result[page])
+            pages.append(tuple(result))
+        return Snapshot(version, len(values), *pages)
+
+    def __lookup(self, pages, _id):
+        mask = (1 << Snapshot.page_bits) - 1
+        return pages[_id >> Snapshot.page_bits][_id & mask]
+
+    def __parent(self, _id):
+        if 0 <= _id < self.__size:
+            return self.__lookup(self.__parents, _id)
+        return Snapshot.unlinked
+
+    @staticmethod
+    def format(name):
+        """Path segment of a dict key or list index."""
+        if type(name) == int:
+            return "[%d]" % name
+        return "." + name
+
+    def get_item(self, _id):
+        if 0 <= _id < self.__size:
+            value = self.__lookup(self.__values, _id)
+            if value is not Snapshot.missing:
+                return value
+        return None
+
+    def get_segments(self, _id):
+        segments: List[str] = []
+        while _id != 0:
+            parent = self.__parent(_id)
+            if parent == Snapshot.unlinked or len(segments) > self.__size:
+                return None
+            segments.append(self.format(self.__lookup(self.__names, _id)))
+            _id = parent
+        segments.reverse()
+        return segments
+
+    def get_path(self, _id):
+        path = self.__paths.get(_id)
+        if path is None:
+            segments = self.get_segments(_id)
+            if segments is None:
+                raise KeyError(_id)
+            path = self.__paths[_id] = "$" + "".join(segments)
+        return path
+
+    def get_id(self, path):
+        try:
+            segments = PathTrie.segments(path)
+        except ValueError:
+            return None
+        _id: Optional[int] = 0
+        for segment in segments:
+            item = self.get_item(_id)
+            if segment[0] == "." and type(item) == dict:
+                index = self.__keys.get(_id)
+                if index is None:
+                    index = {}
+                    for k, v in item.items():
+                        index.setdefault(k.lower(), v)
+                    self.__keys[_id] = index
+                _id = index.get(segment[1:])
+            elif segment[0] == "[" and type(item) == list:
+                index = int(segment[1:-1])
+                _id = item[index] if index < len(item) else None
+            else:
+                return None
+            if _id is None:
+                return None
+        return _id
+
+    def __stored(self, _id):
+        if 0 <= _id < self.__size:
+            return self.__lookup(self.__values, _id)
+        return Snapshot.missing
+
+    def walk(self, _id=0):
+        """Same as `Model.walk` at the version of this snapshot."""
+        item = self.__stored(_id)
+        if item is Snapshot.missing:
+            raise KeyError(_id)
+        visited = {_id}
+        stack = [(_id, item, iter(self.__children(item)))]
+        while stack:
+            (_id, item, children) = stack[-1]
+            for child in children:
+                if child in visited:
+                    self.logger.warn("Skipping id %d, it is reached twice" % child)
+                    continue
+                value = self.__stored(child)
+                if value is not Snapshot.missing:
+                    visited.add(child)
+                    stack.append((child, value, iter(self.__children(value))))
+                    break
+            else:
+                stack.pop()
+                yield [_id, item]
+
+    def dump(self, _id=0, recursive=False):
+        """Same as `Model.dump` at the version of this snapshot."""
+        if recursive:
+            return list(self.walk(_id))
+        item = self.__stored(_id)
+        if item is Snapshot.missing:
+            raise KeyError(_id)
+        return [[_id, item]]
+
+    @staticmethod
+    def __children(value):
+        if type(value) == list:
+            return value
+        elif type(value) == dict:
+            return list(value.values())
+        return ()
 
 
 class Model(object):
     logger = logging.getLogger("pipboy.Model")
 
+    # deliver `update` on separate threads if set to a `Dispatcher`
+    dispatcher: Optional[Dispatcher] = None
+
     server = {
         "info": {"lang": "en", "version": "1.1.30.0"},
         "run_server": False,
@@ -43,19 +437,76 @@ class Model(object):
         "Workshop": [],
     }
 
+    __unlinked = Snapshot.unlinked
+    __missing = Snapshot.missing
+    __page_bits = Snapshot.page_bits
+
     def __clear(self):
-        self.__path = {}
-        self.__items = {}
+        # storage indexed by id: value, parent id and the key or index below it
+        self.__values = []
+        self.__parents = array.array("I")
+        self.__names = []
+        self.__paths = {0: "$"}  # cached get_path results of containers
+        self.__dependents = {}  # id -> ids whose cached path extends its path
+        self.__keys = {}  # id -> lowercase key index of a dict, built on lookup
+        self.__orphans = set()  # ids dropped by their parent since `collect`
+        self.__dirty = None  # pages changed since the last snapshot, None for all
+        self.__journal.clear()
+        self.__journaled = 0  # ids in the journal
+        self.__horizon = self.version + 1  # oldest version `changes_since` serves
+
+    # frames changing at most this many tiles of the last one are dropped
+    map_tolerance = 0
+
+    # ids beyond the stored ones by more than this are rejected, the storage
+    # grows up to the highest id
+    id_headroom = 1 << 20
+
+    # number of changed ids remembered for `changes_since`, 0 disables it, the
+    # ids of the last update are kept even if there are more
+    journal_size = 4096
 
     def __init__(self):
         super(Model, self).__init__()
         self.listener = {"update": [], "command": [], "map_update": []}
+        self.subscriptions = PathTrie()  # `update` listeners below a path
+        self.collected = {"entries": 0, "bytes": 0}
+        # held while items are applied, collected and published
+        self.lock = threading.RLock()
+        self.__applying = 0  # items applied in parts, see `applying`
+        self.__map = None
+        self.__map_requested = False
+        self.version = 0
+        self.__snapshot = Snapshot()
+        # (version, changed ids) by version
+        self.__journal: Deque[Tuple[int, List[int]]] = collections.deque()
         self.load(BuiltinFormat.load(Model.__startup))
 
-    def register(self, typ, function):
-        self.listener[typ].append(function)
+    def register(self, typ, function, path=None):
+        """
+        :param path: for `update` only, deliver just the ids at or below path,
+            see `PathTrie`
+        """
+        if path is None:
+            self.listener[typ].append(function)
+        elif typ == "update":
+            self.subscriptions.add(path, function)
+        else:
+            raise ValueError("Only update listeners can subscribe to a path")
 
-    def unregister(self, typ, function):
+    def unregister(self, typ, function, path=None):
+        if path is not None:
+            try:
+                self.subscriptions.remove(path, function)
+            except ValueError:
+                self.logger.warn(
+                    "Could not remove function {func_name} from {path}.".format(
+                        func_name=function.__name__, path=path
+                    )
+                )
+            if self.dispatcher:
+                self.dispatcher.remove(function)
+            return
         if typ not in self.listener:
             self.logger.warn(
                 "Could not remove function {func_name} from listener {listener}, listener did not exist.".format(
@@ -65,6 +516,8 @@ class Model(object):
             return
         try:
             self.listener[typ].remove(function)
+            if typ == "update" and self.dispatcher:
+                self.dispatcher.remove(function)
         except ValueError:
             self.logger.warn(
                 "Could not remove function {func_name} from listener {listener}, function did not exist.".format(
@@ -72,78 +525,505 @@ class Model(object):
                 )
             )
 
+    def __grow(self, size):
+        missing = size - len(self.__values)
+        if missing > 0:
+            if self.__dirty is not None:
+                first = len(self.__values) >> Model.__page_bits
+                self.__dirty.update(range(first, (size >> Model.__page_bits) + 1))
+            self.__values.extend([Model.__missing] * missing)
+            self.__parents.extend(array.array("I", [Model.__unlinked]) * missing)
+            self.__names.extend([None] * missing)
+
+    def __contains(self, _id):
+        return (
+            0 <= _id < len(self.__values) and self.__values[_id] is not Model.__missing
+        )
+
+    def __parent(self, _id):
+        if 0 <= _id < len(self.__parents):
+            return self.__parents[_id]
+        return Model.__unlinked
+
     def get_item(self, _id):
-        return self.__items.get(_id)
+        if self.__contains(_id):
+            return self.__values[_id]
+        return None
+
+    def get_segments(self, _id):
+        """
+        :return: list of path segments like `.Map` or `[3]` from `$` to _id,
+            None if _id is not linked to `$`
+        """
+        segments: List[str] = []
+        while _id != 0:
+            parent = self.__parent(_id)
+            if parent == Model.__unlinked or len(segments) > len(self.__values):
+                return None
+            segments.append(Snapshot.format(self.__names[_id]))
+            _id = parent
+        segments.reverse()
+        return segments
 
     def get_path(self, _id):
-        if _id == 0:
-            return "$"
-        else:
-            (name, parent) = self.__path[_id]
-            return self.get_path(parent) + name
-
-    def __get_id(self, _id, path):
-        if not path:
-            return _id
-        match = re.match(r"^(\.([a-zA-Z0-9]+)|\[([0-9]+)\])(.*)$", path)
-        if match:
-            item = self.get_item(_id)
-            groups = match.groups()
-            if groups[1] and type(item) == dict:
-                for k, v in list(item.items()):
-                    if k.lower() == groups[1].lower():
-                        return self.__get_id(v, groups[3])
-            elif groups[2] and type(item) == list:
-                try:
-                    idx = int(groups[2])
-                    return self.__get_id(item[idx], groups[3])
-                except Exception as e:
-                    self.logger.error(str(e))
-        return None
+        path = self.__paths.get(_id)
+        if path is not None:
+            return path
+        uncached: List[int] = []
+        # updates must not relink ids between caching their path and dependents
+        with self.lock:
+            while _id not in self.__paths:
+                if len(uncached) > len(self.__values):
+                    raise ValueError("Cyclic path for id %d" % uncached[0])
+                parent = self.__parent(_id)
+                if parent == Model.__unlinked:
+                    raise KeyError(_id)
+                uncached.append(_id)
+                _id = parent
+            path = self.__paths[_id]
+            for _id in reversed(uncached):
+                path += Snapshot.format(self.__names[_id])
+                value = self.__values[_id]
+                if _id == uncached[0] and type(value) != list and type(value) != dict:
+                    break  # a leaf, its path is built from its parent's
+                self.__paths[_id] = path
+                self.__dependents.setdefault(self.__parents[_id], set()).add(_id)
+        return path
+
+    def __invalidate(self, _id):
+        stack = [_id]
+        while stack:
+            _id = stack.pop()
+            if self.__paths.pop(_id, None) is not None:
+                stack.extend(self.__dependents.pop(_id, ()))
+
+    def __relink(self, _id, name, parent):
+        previous = self.__parents[_id]
+        self.__parents[_id] = parent
+        self.__names[_id] = name
+        if self.__dirty is not None:
+            self.__dirty.add(_id >> Model.__page_bits)
+        if _id in self.__paths and _id != 0:
+            self.__dependents.get(previous, set()).discard(_id)
+            self.__invalidate(_id)
+
+    __segment = re.compile(r"\.([a-zA-Z0-9]+)|\[([0-9]+)\]")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def __parse_path(path):
+        """
+        Splits a path below `$` into segments.
+        :return: tuple of (key, lowercase key, None) or (None, None, index),
+            None if the path is malformed
+        """
+        segments: List[Tuple[Optional[str], Optional[str], Optional[int]]] = []
+        pos = 0
+        while pos < len(path):
+            match = Model.__segment.match(path, pos)
+            if not match:
+                return None
+            (key, index) = match.groups()
+            if key:
+                segments.append((key, key.lower(), None))
+            else:
+                segments.append((None, None, int(index)))
+            pos = match.end()
+        return tuple(segments)
+
+    def __key_index(self, _id):
+        index = self.__keys.get(_id)
+        if index is None:
+            # built from the stored dict, `apply` drops it when that is replaced
+            with self.lock:
+                item = self.__values[_id]
+                if type(item) != dict:
+                    return {}
+                index = {}
+                for k, v in item.items():
+                    index.setdefault(k.lower(), v)
+                self.__keys[_id] = index
+        return index
 
     def get_id(self, path):
-        if path.startswith("$"):
-            return self.__get_id(0, path[1:])
-        return None
+        if not path.startswith("$"):
+            return None
+        segments = Model.__parse_path(path[1:])
+        values = self.__values
+        if segments is None or not values:
+            return None
+        _id = 0
+        for key, lower, index in segments:
+            item = values[_id]  # stored containers only refer to ids in range
+            if key is not None and type(item) == dict:
+                child = item.get(key)
+                if child is None:
+                    child = self.__key_index(_id).get(lower)
+            elif index is not None and type(item) == list:
+                try:
+                    child = item[index]
+                except IndexError as e:
+                    self.logger.error(str(e))
+                    return None
+            else:
+                return None
+            if child is None:
+                return None
+            _id = child
+        return _id
 
-    def update(self, items):
+    def apply(self, items):
+        """
+        Stores items without notifying the `update` listeners. They are not
+        visible to `snapshot` before `notify` either.
+        :param items: list of [id, value] pairs, a `DictUpdate` is merged into
+            the stored dict
+        :return: list of changed ids, to be passed to `notify`
+        """
         changed = []
+        limit = len(self.__values) + self.id_headroom
+        values = self.__values
+        parents = self.__parents
+        names = self.__names
+        dirty = self.__dirty
+        if dirty is None:
+            dirty = set()  # everything is copied anyway
         for _id, value in items:
-            self.__items[_id] = value
+            if type(_id) != int or not 0 <= _id < limit:
+                self.logger.error("Ignoring entry with invalid id %r" % _id)
+                continue
+            if _id >= len(values):
+                self.__grow(_id + 1)
+            previous = values[_id]
+            if type(value) == DictUpdate:
+                value = value.merge(previous)
+            if type(value) == list or type(value) == dict:
+                highest = self.__highest(self.__children(value), limit)
+                if highest is None:
+                    self.logger.error("Ignoring entry %d, invalid child ids" % _id)
+                    continue
+                self.__grow(highest + 1)
+            dirty.add(_id >> Model.__page_bits)
+            if type(previous) == list or type(previous) == dict:
+                self.__drop(previous, value)
+            values[_id] = value
+            self.__keys.pop(_id, None)
             changed.append(_id)
             if type(value) == list:
                 for k, v in enumerate(value):
-                    self.__path[v] = ("[%d]" % k, _id)
+                    if parents[v] != _id or names[v] != k:
+                        self.__relink(v, k, _id)
             elif type(value) == dict:
                 for k, v in list(value.items()):
-                    self.__path[v] = (".%s" % k, _id)
+                    if parents[v] != _id or names[v] != k:
+                        self.__relink(v, k, _id)
+        return changed
+
+    @contextlib.contextmanager
+    def applying(self):
+        """
+        Marks items as applied in parts, each `apply` under `lock` but not the
+        whole. Children may come before the parent linking them, so `collect`
+        removes nothing until the last part is applied.
+        """
+        with self.lock:
+            self.__applying += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.__applying -= 1
+
+    @staticmethod
+    def __children(value):
+        if type(value) == list:
+            return value
+        elif type(value) == dict:
+            return value.values()
+        return ()
+
+    @staticmethod
+    def __highest(children, limit):
+        """Highest child id, -1 if none, None if one is not an id below limit."""
+        if not children:
+            return -1
+        try:
+            highest = max(array.array("I", children))  # raises for non-ids
+        except (TypeError, OverflowError):
+            return None
+        return highest if highest < limit else None
+
+    def __drop(self, previous, value):
+        dropped = set(self.__children(previous))
+        dropped.difference_update(self.__children(value))
+        self.__orphans |= dropped
+
+    def __attached(self, _id):
+        """Whether the parent links of _id lead to `$`."""
+        for _ in range(0, len(self.__values) + 1):
+            if _id == 0:
+                return True
+            parent = self.__parent(_id)
+            if parent == Model.__unlinked:
+                return False
+            name = self.__names[_id]
+            value = self.get_item(parent)
+            if type(value) == dict:
+                if value.get(name) != _id:
+                    return False
+            elif type(value) == list:
+                if type(name) != int or name >= len(value) or value[name] != _id:
+                    return False
+            else:
+                return False
+            _id = parent
+        return False
+
+    def __remove(self, _id):
+        """Removes _id and every child still linked to it."""
+        entries = 0
+        size = 0
+        stack = [_id]
+        while stack:
+            _id = stack.pop()
+            value = self.__values[_id]
+            parent = self.__parents[_id]
+            self.__values[_id] = Model.__missing
+            self.__parents[_id] = Model.__unlinked
+            self.__names[_id] = None
+            if self.__dirty is not None:
+                self.__dirty.add(_id >> Model.__page_bits)
+            if _id in self.__paths:
+                self.__dependents.get(parent, set()).discard(_id)
+                self.__invalidate(_id)
+            self.__keys.pop(_id, None)
+            entries += 1
+            size += sys.getsizeof(value)
+            for child in self.__children(value):
+                if self.__parent(child) == _id and self.__contains(child):
+                    stack.append(child)
+        return (entries, size)
+
+    def collect(self, full=False):
+        """
+        Removes entries that are no longer reachable from `$`. Without `full`
+        only the subtrees dropped from their parents since the last call are
+        checked, a full collection marks everything reachable and removes the
+        rest.
+        :return: number of removed entries and their approximate size in bytes
+        """
+        if self.__applying:
+            return (0, 0)  # the orphans are checked once all parts are applied
+        entries = 0
+        size = 0
+        orphans: Iterable[int] = self.__orphans
+        self.__orphans = set()
+        if full:
+            reachable = {0}
+            stack = [0]
+            while stack:
+                for child in self.__children(self.get_item(stack.pop())):
+                    if child not in reachable and self.__contains(child):
+                        reachable.add(child)
+                        stack.append(child)
+            orphans = [
+                _id
+                for _id, value in enumerate(self.__values)
+                if value is not Model.__missing and _id not in reachable
+            ]
+        for _id in orphans:
+            if self.__contains(_id) and (full or not self.__attached(_id)):
+                (count, freed) = self.__remove(_id)
+                entries += count
+                size += freed
+        if entries:
+            self.collected["entries"] += entries
+            self.collected["bytes"] += size
+            self.logger.debug("collected %d entries, %d bytes" % (entries, size))
+        return (entries, size)
+
+    def __route(self, changed):
+        routed: Dict[Any, List[int]] = {}
+        for _id in changed:
+            segments = self.get_segments(_id)
+            if segments is None:
+                continue
+            for func in self.subscriptions.match(segments):
+                ids = routed.setdefault(func, [])
+                if not ids or ids[-1] != _id:
+                    ids.append(_id)
+        return routed
+
+    def __record(self, changed):
+        if not self.journal_size:
+            self.__horizon = self.version
+            return
+        journal = self.__journal
+        journal.append((self.version, changed))
+        self.__journaled += len(changed)
+        while self.__journaled > self.journal_size and len(journal) > 1:
+            (version, ids) = journal.popleft()
+            self.__journaled -= len(ids)
+            self.__horizon = version
+
+    def __publish(self, changed):
+        if self.__dirty is None or self.__dirty:
+            self.version += 1
+            self.__record(changed)
+            snapshot = self.__snapshot if self.__dirty is not None else Snapshot()
+            self.__snapshot = snapshot.derive(
+                self.version, self.__values, self.__parents, self.__names, self.__dirty
+            )
+            self.__dirty = set()
+
+    def snapshot(self):
+        """
+        :return: `Snapshot` of the model as of the last `notify`, it does not
+            change while updates continue
+        """
+        return self.__snapshot
+
+    def changes_since(self, seq):
+        """
+        What changed after version seq, e.g. of an earlier `snapshot`.
+        :return: the current snapshot and its [id, value] entries of the ids
+            changed since seq in the order of their last change, None if the
+            journal does not reach back that far and a full `dump` is needed
+        """
+        snapshot = self.__snapshot
+        if seq < self.__horizon or seq > snapshot.version:
+            return None
+        # newest first, updates appended meanwhile shift the older ones to
+        # lower indexes, so none is skipped
+        journal = self.__journal
+        latest: Dict[int, None] = {}  # ordered set of ids, latest change first
+        back = 1
+        try:
+            while back <= len(journal):
+                (version, ids) = journal[-back]
+                back += 1
+                if version <= seq:
+                    break
+                if version <= snapshot.version:
+                    for _id in reversed(ids):
+                        latest.setdefault(_id, None)
+        except IndexError:
+            pass  # cleared meanwhile
+        if seq < self.__horizon:
+            return None  # dropped from the journal meanwhile
+        entries = []
+        for _id in reversed(list(latest)):
+            try:
+                entries += snapshot.dump(_id)
+            except KeyError:
+                pass  # collected since
+        return (snapshot, entries)
+
+    def notify(self, changed):
+        # ids changed and collected by the same update are gone for listeners
+        changed = [_id for _id in changed if self.__contains(_id)]
+        self.__publish(changed)
+        routed = self.__route(changed) if len(self.subscriptions) else {}
+        dispatcher = self.dispatcher
+        if dispatcher:
+            dispatcher.dispatch(self.listener["update"], changed)
+            for func, ids in routed.items():
+                dispatcher.dispatch([func], ids)
+            return
         for func in self.listener["update"]:
             func(changed)
+        for func, ids in routed.items():
+            func(ids)
+
+    def update(self, items):
+        with self.lock:
+            changed = self.apply(items)
+            self.collect()
+            self.notify(changed)
+
+    def gc(self):
+        """
+        Full `collect` between updates, the result is published like one if
+        anything was removed.
+        :return: number of removed entries and their approximate size in bytes
+        """
+        with self.lock:
+            result = self.collect(full=True)
+            if result[0]:
+                self.notify([])
+        return result
+
+    # command asking the game for the local map, its answer is never dropped
+    map_request = 13
 
     def command(self, _type, args):
+        if _type == self.map_request:
+            self.__map_requested = True
         for func in self.listener["command"]:
             func(_type, args)
 
-    def map_update(self, data):
+    @property
+    def local_map(self):
+        """The last `LocalMap` passed to the `map_update` listeners."""
+        return self.__map
+
+    def map_update(self, local_map):
+        changed = local_map.diff(self.__map)
+        if (
+            len(changed) <= self.map_tolerance
+            and self.__map is not None
+            and not self.__map_requested
+        ):
+            self.logger.debug("map unchanged, %d tiles differ" % len(changed))
+            return
+        local_map.changed = changed
+        self.__map = local_map
+        self.__map_requested = False
         for func in self.listener["map_update"]:
-            func(data)
+            func(local_map)
+
+    def clear(self):
+        with self.lock:
+            self.__clear()
 
     def load(self, items):
-        self.__clear()
-        self.update(items)
+        with self.lock:
+            self.__clear()
+            self.update(items)
+
+    def walk(self, _id=0):
+        """
+        Generates the [id, value] entries of _id and everything below it,
+        depth-first with children before their parent. Ids that are referenced
+        but not stored are skipped, and so are ids reached a second time, so a
+        cycle ends the walk.
+        """
+        if not self.__contains(_id):
+            raise KeyError(_id)
+        item = self.__values[_id]
+        visited = {_id}
+        stack = [(_id, item, iter(self.__children(item)))]
+        while stack:
+            (_id, item, children) = stack[-1]
+            for child in children:
+                if child in visited:
+                    self.logger.warn("Skipping id %d, it is reached twice" % child)
+                    continue
+                if self.__contains(child):
+                    visited.add(child)
+                    value = self.__values[child]
+                    stack.append((child, value, iter(self.__children(value))))
+                    break
+            else:
+                stack.pop()
+                yield [_id, item]
 
     def dump(self, _id=0, recursive=False):
-        item = self.__items[_id]
-        result = []
         if recursive:
-            if type(item) == list:
-                for child in item:
-                    result += self.dump(child, recursive)
-            elif type(item) == dict:
-                for child in list(item.values()):
-                    result += self.dump(child, recursive)
-        result.append([_id, item])
-        return result
+            return list(self.walk(_id))
+        if not self.__contains(_id):
+            raise KeyError(_id)
+        return [[_id, self.__values[_id]]]
 
 
 class View(object):
@@ -162,6 +1042,7 @@ class View(object):
     def __init__(self, model):
         self.model = model
         self.should_spam = True
+        self.ignored = PathTrie(self.ignore)
         model.register("update", self.listen_update)
         model.register("command", self.listen_command)
         model.register("map_update", self.listen_map_update)
@@ -175,14 +1056,12 @@ class View(object):
         for item in items:
             if not isinstance(item, int):
                 self.logger.debug("strange model.")
+            segments = self.model.get_segments(item)
+            if segments is None or self.ignored.match(segments, prefix=False):
+                continue
             path = self.model.get_path(item)
-            ig = False
-            for i in self.ignore:
-                if i.lower() == path.lower():
-                    ig = True
-            if not ig:
-                item = self.model.get_item(item)
-                self.print_update(path, item)
+            item = self.model.get_item(item)
+            self.print_update(path, item)
 
     def listen_command(self, _type, args):
         """
@@ -193,10 +1072,11 @@ class View(object):
         """
         print(("{type} {args}".format(type=_type, args=args)))
 
-    def listen_map_update(self, data):
+    def listen_map_update(self, local_map):
         """
         This function receives the data for the local map.
-        :param data: the data
+        :param local_map: LocalMap, pixels are a view into the received packet,
+            `changed` lists the tiles that differ from the previous frame
         """
         pass
 
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
-import io
+import asyncio
+import collections
+import concurrent.futures
+import heapq
+import itertools
 import json
 import logging
 import socket
@@ -9,8 +13,10 @@ import struct
 import threading
 import time
 
-from .format import TCPFormat
-from .mvc import Model
+from typing import Any, Deque, Dict, Optional
+
+from .format import DictUpdate, LocalMap, TCPDecoder, TCPFormat
+from .mvc import Model, Snapshot
 
 
 TCP_PORT = 27000
@@ -23,6 +29,12 @@ class Disconnected(Exception):
 class TCPHandler:
     logger = logging.getLogger("pipboy.TCPHandler")
 
+    # provided by the concrete handler and socketserver.StreamRequestHandler
+    model: Model
+    switch: str
+    rfile: Any
+    wfile: Any
+
     def _old__init__(self, request, client_address, base_server):
         self.request = request
         self.client_address = client_address
@@ -33,28 +45,212 @@ class TCPHandler:
             )
         )
 
-    def receive(self):
+    chunk_size = 65536
+
+    def receive_header(self):
         self.logger.debug("receive")
         header = self.rfile.read(5)
         if len(header) == 0:
             raise Disconnected("receive")
+        self.last_received = time.monotonic()
         try:
             size, channel = struct.unpack("<IB", header)
         except Exception:
             self.logger.exception("header: '{}'".format(header))
             raise
-        data = self.rfile.read(size)
-        return (channel, data)
+        return (size, channel)
+
+    def receive_chunks(self, size):
+        while size > 0:
+            chunk = self.rfile.read1(min(size, self.chunk_size))
+            if len(chunk) == 0:
+                raise Disconnected("receive")
+            self.last_received = time.monotonic()
+            size -= len(chunk)
+            yield chunk
+
+    # write header and data with one sendmsg call where the platform has it
+    vectored = hasattr(socket.socket, "sendmsg")
+    # seconds a packet may wait to be sent together with the following ones
+    coalesce_window = 0.0
+    # buffers passed to one sendmsg call, below IOV_MAX
+    max_buffers = 512
+
+    def setup_send(self, flusher=True):
+        """
+        :param flusher: start a thread sending coalesced packets once their
+            window passed, without it they wait for the next `flush`
+        """
+        self.sent = {"frames": 0, "syscalls": 0, "bytes": 0}
+        self.last_sent = self.last_received = time.monotonic()
+        # held while a whole packet is written, keepalives must not split one
+        self.send_lock = threading.RLock()
+        self.__pending = []
+        self.__unsent = b""  # rest of a keepalive the socket took only in part
+        self.__closed = False
+        self.__condition = threading.Condition()
+        if self.coalesce_window > 0 and flusher:
+            thread = threading.Thread(target=self.__coalesce, name="Coalesce")
+            thread.daemon = True
+            thread.start()
+
+    def close_send(self):
+        with self.__condition:
+            if self.__pending and not self.__closed:
+                try:
+                    self.__sendmsg(self.__pending)
+                except OSError as e:
+                    self.logger.warn("Sending failed: {}".format(e))
+                self.__pending = []
+            self.__closed = True
+            self.__condition.notify()
+
+    def send_stats(self):
+        stats: Dict[str, float] = dict(self.sent)
+        stats["frames_per_syscall"] = (
+            stats["frames"] / stats["syscalls"] if stats["syscalls"] else 0.0
+        )
+        return stats
+
+    def __sendmsg(self, buffers):
+        """Sends all buffers, must be called holding the condition."""
+        if self.__unsent:
+            buffers = [self.__unsent] + list(buffers)
+            self.__unsent = b""
+        self.sent["bytes"] += sum(len(buffer) for buffer in buffers)
+        self.last_sent = time.monotonic()
+        if not self.vectored:
+            for buffer in buffers:
+                self.wfile.write(buffer)
+                self.sent["syscalls"] += 1
+            return
+        buffers = [buffer for buffer in buffers if len(buffer)]
+        while buffers:
+            size = self.request.sendmsg(buffers[: self.max_buffers])
+            self.sent["syscalls"] += 1
+            while size:
+                if size >= len(buffers[0]):
+                    size -= len(buffers.pop(0))
+                else:
+                    buffers[0] = memoryview(buffers[0])[size:]
+                    size = 0
+
+    def __coalesce(self):
+        window = self.coalesce_window
+        with self.__condition:
+            while True:
+                while not self.__pending and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    return
+                deadline = time.monotonic() + window
+                while not self.__closed and time.monotonic() < deadline:
+                    self.__condition.wait(deadline - time.monotonic())
+                try:
+                    self.__sendmsg(self.__pending)
+                except OSError as e:
+                    self.logger.warn("Sending failed: {}".format(e))
+                    self.__closed = True
+                self.__pending = []
+
+    def flush(self):
+        """Sends the packets waiting for the coalescing window."""
+        with self.__condition:
+            if self.__pending:
+                (pending, self.__pending) = (self.__pending, [])
+                self.__sendmsg(pending)
+
+    def write(self, buffers, flush=False, frames=1):
+        """
+        Sends buffers holding `frames` packets, they are queued for the
+        coalescing window unless it is disabled or flush is set.
+        """
+        with self.__condition:
+            self.sent["frames"] += frames
+            if self.coalesce_window > 0 and not flush and not self.__closed:
+                self.__pending += buffers
+                self.__condition.notify()
+                return
+            if self.__pending:
+                (pending, self.__pending) = (self.__pending, [])
+                self.__sendmsg(pending)
+            self.__sendmsg(buffers)
 
     def send(self, channel, data):
         self.logger.debug("send {channel}: {data}".format(channel=channel, data=data))
-        header = struct.pack("<IB", len(data), channel)
-        self.wfile.write(header)
-        self.wfile.write(data)
+        with self.send_lock:
+            self.write([struct.pack("<IB", len(data), channel), data])
+
+    def send_chunks(self, channel, size, chunks):
+        """
+        Sends a packet of `size` bytes whose data is produced by `chunks`,
+        every chunk is written as soon as it is ready.
+        """
+        self.logger.debug(
+            "send {channel}: {size} bytes".format(channel=channel, size=size)
+        )
+        buffers = [struct.pack("<IB", size, channel)]
+        with self.send_lock:
+            for chunk in chunks:
+                self.write(buffers + [chunk], flush=True, frames=len(buffers))
+                buffers = []
+                size -= len(chunk)
+            if buffers:
+                self.write(buffers, flush=True)
+        if size != 0:
+            raise ValueError("Packet size mismatch by %d bytes" % size)
+
+    __keepalive_packet = struct.pack("<IB", 0, 0)
+
+    def keepalive(self):
+        """
+        Sends a keepalive packet unless another packet is being sent or
+        waits in the socket buffer, never blocks. What the socket did not take
+        goes out with the next call or packet. Returns True if sent entirely.
+        """
+        if not self.send_lock.acquire(blocking=False):
+            return False
+        try:
+            # the Coalesce thread holds the condition while it sends
+            if not self.__condition.acquire(blocking=False):
+                return False
+            try:
+                if self.__pending or self.__closed:
+                    return False
+                data = self.__unsent or TCPHandler.__keepalive_packet
+                flags = getattr(socket, "MSG_DONTWAIT", 0)
+                size = self.request.send(data, flags)
+                if not self.__unsent:
+                    self.sent["frames"] += 1
+                self.__unsent = data[size:]
+                self.sent["syscalls"] += 1
+                self.sent["bytes"] += size
+                self.last_sent = time.monotonic()
+                return not self.__unsent
+            finally:
+                self.__condition.release()
+        except BlockingIOError:
+            return False
+        finally:
+            self.send_lock.release()
+
+    # turn `switch` off once the connection ends, a server serves its other
+    # apps on and leaves that to `TCPServer.shutdown`
+    owns_switch = True
+    # cleared by `disconnect`, it ends the receiving loop of this connection only
+    connected = True
+
+    def disconnect(self):
+        """Shuts the connection down, the receiving loop ends with it."""
+        self.connected = False
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def __handle_heartbeat(self, data):
+        # the receive time is all that counts, see Keepalive
         self.logger.debug("handle_heartbeat")
-        self.send(0, b"")
 
     def __handle_config(self, data):
         self.logger.debug("handle_config")
@@ -66,12 +262,40 @@ class TCPHandler:
 
     def __handle_update(self, data):
         self.logger.debug("handle_update")
-        stream = io.BytesIO(data)
-        self.model.update(TCPFormat.load(stream))
+        self.model.update(TCPFormat.loads(data))
+
+    # False until the first channel 3 packet, which carries the whole database
+    synced = True
+
+    def __stream_update(self, size):
+        self.logger.debug("stream_update")
+        decoder = TCPDecoder()
+        changed = []
+        if not self.synced:
+            self.model.clear()
+            self.synced = True
+        # the lock is not held while waiting for the game
+        try:
+            with self.model.applying():
+                for chunk in self.receive_chunks(size):
+                    decoder.feed(chunk)
+                    with self.model.lock:
+                        changed += self.model.apply(decoder.entries())
+        finally:
+            with self.model.lock:
+                self.model.collect()
+                self.model.notify(changed)
+        if decoder.pending:
+            self.logger.warn("Incomplete update, %d bytes left" % decoder.pending)
 
     def __handle_map(self, data):
         self.logger.debug("handle_map")
-        self.model.map_update(data)
+        try:
+            local_map = LocalMap(data)
+        except (ValueError, struct.error) as e:
+            self.logger.error(str(e))
+            return
+        self.model.map_update(local_map)
 
     def __handle_command(self, data):
         self.logger.debug("handle_command")
@@ -89,25 +313,38 @@ class TCPHandler:
         5: __handle_command,
     }
 
+    __stream = {
+        3: __stream_update,
+    }
+
     def handle(self):
         self.logger.debug("handle")
-        while self.model.server[self.switch]:
+        while self.connected and self.model.server[self.switch]:
             try:
-                (channel, data) = self.receive()
+                (size, channel) = self.receive_header()
+                if channel in self.__stream:
+                    self.__stream[channel](self, size)
+                    continue
+                data = self.rfile.read(size)
+                if len(data) < size:
+                    raise Disconnected("receive")
+                self.last_received = time.monotonic()
             except Disconnected:
-                self.logger.warn("Disconnected. Turned off {}.".format(self.switch))
-                self.model.server[self.switch] = False
+                if self.owns_switch:
+                    self.logger.warn("Disconnected. Turned off {}.".format(self.switch))
+                    self.model.server[self.switch] = False
+                else:
+                    self.logger.info("{} disconnected".format(self.client_address))
+                self.connected = False
                 self.finish()
                 break
-            if channel in self.__handler:
-                self.__handler[channel](self, data)
-            else:
-                self.logger.warn("Error Unknown Channel %d : %s" % (channel, data))
+            self.dispatch(channel, data)
 
-    def send_updates(self, items):
-        stream = io.BytesIO()
-        TCPFormat.dump(items, stream)
-        self.send(3, stream.getvalue())
+    def dispatch(self, channel, data):
+        if channel in self.__handler:
+            self.__handler[channel](self, data)
+        else:
+            self.logger.warn("Error Unknown Channel %d : %s" % (channel, data))
 
     __command_idx = 1
 
@@ -121,39 +358,440 @@ class TCPHandler:
         self.__command_idx += 1
 
 
+# packet including its header as sent to every app, a channel 3 frame turns
+# the model at version `since` into `snapshot`
+Frame = collections.namedtuple("Frame", ["channel", "data", "since", "snapshot"])
+
+
+class Broadcast(object):
+    """
+    Encodes every change of the model once for all connected apps and passes
+    the resulting `Frame` to the subscribers. Dicts are sent as their
+    difference to the previous version.
+    """
+
+    logger = logging.getLogger("pipboy.Broadcast")
+
+    def __init__(self, model):
+        self.model = model
+        self.encoded = 0
+        self.__snapshot = model.snapshot()
+        self.__subscribers = []
+        self.__lock = threading.Lock()
+        # latest map frame, new subscribers get it right away
+        self.map = None
+        if model.local_map is not None:
+            self.map = self.frame(4, model.local_map.data)
+        model.register("update", self.listen_update)
+        model.register("map_update", self.listen_map_update)
+
+    def close(self):
+        self.model.unregister("update", self.listen_update)
+        self.model.unregister("map_update", self.listen_map_update)
+
+    def subscribe(self, function):
+        with self.__lock:
+            self.__subscribers.append(function)
+            if self.map is not None:
+                function(self.map)
+
+    def unsubscribe(self, function):
+        try:
+            self.__subscribers.remove(function)
+        except ValueError:
+            pass
+
+    @staticmethod
+    def frame(channel, data):
+        return Frame(channel, struct.pack("<IB", len(data), channel) + data, None, None)
+
+    @staticmethod
+    def delta(previous, entries):
+        """Replaces dicts by their difference to the value in snapshot previous."""
+        for entry in entries:
+            (_id, value) = entry
+            if previous is not None and type(value) == dict:
+                before = previous.get_item(_id)
+                if type(before) == dict:
+                    entry[1] = DictUpdate.diff(before, value)
+            yield entry
+
+    def changes(self, previous):
+        """
+        :return: current snapshot and the channel 3 data updating an app that
+            has snapshot previous, None if it needs the whole model again
+        """
+        changes = self.model.changes_since(previous.version)
+        if changes is None:
+            return None
+        (snapshot, entries) = changes
+        if not entries:
+            return (snapshot, b"")
+        self.encoded += 1
+        return (snapshot, TCPFormat.dumps(list(self.delta(previous, entries))))
+
+    def __publish(self, frame):
+        for function in list(self.__subscribers):
+            try:
+                function(frame)
+            except Exception:
+                self.logger.exception("Subscriber {} failed".format(function))
+
+    def listen_update(self, items):
+        with self.__lock:
+            previous = self.__snapshot
+            changes = self.changes(previous)
+            if changes is None:
+                # after `Model.clear` the journal starts over, items is the change
+                snapshot = self.model.snapshot()
+                if snapshot.version != previous.version + 1:
+                    self.logger.warn("Journal exceeded, sending the changed ids only")
+                entries = []
+                for item in items:
+                    try:
+                        entries += snapshot.dump(item, False)
+                    except KeyError:
+                        pass  # collected before it was sent
+                data = TCPFormat.dumps(list(self.delta(previous, entries)))
+                changes = (snapshot, data)
+            (snapshot, data) = changes
+            if snapshot.version == previous.version:
+                return
+            self.__snapshot = snapshot
+            if not data:
+                return  # nothing the apps have to know
+            data = struct.pack("<IB", len(data), 3) + data
+            self.__publish(Frame(3, data, previous.version, snapshot))
+
+    def listen_map_update(self, local_map):
+        with self.__lock:
+            self.map = self.frame(4, local_map.data)
+            self.__publish(self.map)
+
+
+class Replica(object):
+    """
+    The model as one app has it, shared by `TCPServerHandler` and
+    `AsyncTCPSession`. Decides which broadcast frames the app gets and what
+    it needs to catch up.
+    """
+
+    logger = logging.getLogger("pipboy.Replica")
+
+    # entries encoded at a time while sending the whole model
+    sync_batch = 1024
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.snapshot: Optional[Snapshot] = None  # None before the first sync
+
+    def __encode(self, entries):
+        while True:
+            batch = list(itertools.islice(entries, self.sync_batch))
+            if not batch:
+                return
+            yield TCPFormat.dumps(batch)
+
+    def sync(self):
+        """
+        Brings the app up to date, from the journal if it reaches back far
+        enough, else by sending the whole model. The app is taken to have the
+        result.
+        :return: size of the channel 3 packet and its data in chunks encoded as
+            they are taken, size 0 if nothing changed
+        """
+        previous = self.snapshot
+        if previous is not None:
+            changes = self.broadcast.changes(previous)
+            if changes is not None:
+                (self.snapshot, data) = changes
+                return (len(data), [data] if data else [])
+            self.logger.warn("Changes since the last update were lost, resending")
+        snapshot = self.snapshot = self.broadcast.model.snapshot()
+        size = TCPFormat.size(Broadcast.delta(previous, snapshot.walk()))
+        return (size, self.__encode(Broadcast.delta(previous, snapshot.walk())))
+
+    def follows(self, frame):
+        """
+        Whether frame can be sent to the app as it is, it is taken as sent.
+        :return: True to send it, False if the app has it already, None if
+            frames in between were replaced and the app has to `sync` instead
+        """
+        if frame.channel != 3 or frame.snapshot is None:
+            return True
+        snapshot = self.snapshot
+        if snapshot is not None and frame.snapshot.version <= snapshot.version:
+            return False
+        if snapshot is None or frame.since != snapshot.version:
+            return None
+        self.snapshot = frame.snapshot
+        return True
+
+
+class Outbox(object):
+    """
+    Frames waiting to be sent to one app. A waiting update frame is replaced
+    by the next one, the app then catches up with the latest value of every
+    changed id. A waiting map frame is replaced by the newer one as well,
+    other frames are kept in order.
+    """
+
+    # frames put since the app last took any, it is disconnected beyond that
+    limit = 1024
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__frames: Deque[Frame] = collections.deque()
+        self.__update = None
+        self.__map = None
+        self.__count = 0
+        self.closed = False
+        self.replaced = 0
+
+    def put(self, frame):
+        """
+        :return: False if the app exceeded `limit` and has to be disconnected
+        """
+        with self.__condition:
+            self.__count += 1
+            if self.__count > self.limit:
+                return False
+            if frame.channel == 3 and frame.snapshot is not None:
+                if self.__update is not None:
+                    self.replaced += 1
+                self.__update = frame
+            elif frame.channel == 4:
+                if self.__map is not None:
+                    self.replaced += 1
+                self.__map = frame
+            else:
+                self.__frames.append(frame)
+            self.__condition.notify()
+            return True
+
+    def take(self):
+        """Removes and returns all waiting frames."""
+        with self.__condition:
+            frames = list(self.__frames)
+            self.__frames.clear()
+            frames += [frame for frame in (self.__map, self.__update) if frame]
+            self.__map = None
+            self.__update = None
+            self.__count = 0
+            return frames
+
+    def get(self):
+        """Waits for frames and takes them, None once closed."""
+        with self.__condition:
+            while not (self.closed or self.__frames or self.__map or self.__update):
+                self.__condition.wait()
+            if self.closed:
+                return None
+            return self.take()
+
+    def close(self):
+        with self.__condition:
+            self.closed = True
+            self.__condition.notify_all()
+
+
+class Keepalive(object):
+    """
+    Sends the keepalives of all connections from one thread. A connection
+    gets a keepalive only after `interval` seconds without any packet sent,
+    and is shut down after `timeout` seconds without any packet received.
+    """
+
+    logger = logging.getLogger("pipboy.Keepalive")
+
+    # seconds without sending before a keepalive is sent
+    interval = 1.0
+    # seconds without receiving before the peer counts as gone, 0 to wait forever
+    timeout = 10.0
+
+    __shared: Optional["Keepalive"] = None
+    __shared_lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        """The instance used by all `TCPHandler`s."""
+        with Keepalive.__shared_lock:
+            if Keepalive.__shared is None:
+                Keepalive.__shared = Keepalive()
+            return Keepalive.__shared
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__heap = []  # (deadline, sequence, handler)
+        self.__sequence = itertools.count()
+        self.__handlers = set()
+        self.__thread = None
+
+    def add(self, handler):
+        with self.__condition:
+            self.__handlers.add(handler)
+            self.__schedule(handler)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="Keepalive")
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify()
+
+    def remove(self, handler):
+        with self.__condition:
+            self.__handlers.discard(handler)
+
+    def __schedule(self, handler):
+        deadline = handler.last_sent + self.interval
+        if self.timeout:
+            deadline = min(deadline, handler.last_received + self.timeout)
+        # a busy handler skips its keepalive, check it again a bit later
+        deadline = max(deadline, time.monotonic() + self.interval / 10)
+        heapq.heappush(self.__heap, (deadline, next(self.__sequence), handler))
+
+    def __due(self):
+        """Waits for and removes the handlers whose deadline passed."""
+        while True:
+            while not self.__heap:
+                self.__condition.wait()
+            now = time.monotonic()
+            if self.__heap[0][0] <= now:
+                break
+            self.__condition.wait(self.__heap[0][0] - now)
+        due = []
+        while self.__heap and self.__heap[0][0] <= now:
+            handler = heapq.heappop(self.__heap)[2]
+            if handler in self.__handlers:
+                due.append(handler)
+        return due
+
+    def __check(self, handler):
+        now = time.monotonic()
+        if self.timeout and now - handler.last_received > self.timeout:
+            self.logger.warn(
+                "Disconnecting {}, nothing received for {:.1f}s".format(
+                    handler.client_address, now - handler.last_received
+                )
+            )
+            self.remove(handler)
+            handler.disconnect()
+        elif now - handler.last_sent >= self.interval:
+            try:
+                handler.keepalive()
+            except OSError as e:
+                self.logger.warn("Keepalive failed: {}".format(e))
+                self.remove(handler)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                due = self.__due()
+            for handler in due:
+                self.__check(handler)
+            with self.__condition:
+                for handler in due:
+                    if handler in self.__handlers:
+                        self.__schedule(handler)
+
+
 class TCPServerHandler(TCPHandler, socketserver.StreamRequestHandler):
     logger = logging.getLogger("pipboy.TCPServerHandler")
     switch = "run_server"
+    owns_switch = False
+    server: "TCPServer"
 
-    def listen_update(self, items):
-        updates = []
-        for item in items:
-            updates += self.model.dump(item, False)
-        self.send_updates(updates)
+    def __sync(self):
+        (size, chunks) = self.replica.sync()
+        if size:
+            self.send_chunks(3, size, chunks)
 
-    def listen_map_update(self, data):
-        self.send(4, data)
+    def __deliver(self, frame):
+        follows = self.replica.follows(frame)
+        if follows is None:
+            self.__sync()
+        elif follows:
+            self.write([frame.data])
+
+    def __drain(self):
+        """Sends the frames of the outbox, coalescing them if enabled."""
+        while True:
+            frames = self.outbox.get()
+            if frames is None:
+                return
+            if self.coalesce_window > 0:
+                time.sleep(self.coalesce_window)
+                frames += self.outbox.take()
+            try:
+                with self.send_lock:
+                    for frame in frames:
+                        self.__deliver(frame)
+                    self.flush()
+            except OSError as e:
+                self.logger.warn(
+                    "Sending to {} failed: {}".format(self.client_address, e)
+                )
+                self.outbox.close()
+                self.disconnect()
+
+    def listen_frame(self, frame):
+        if self.outbox.closed:
+            return
+        if not self.outbox.put(frame):
+            self.logger.warn(
+                "Disconnecting {}, it fell too far behind".format(self.client_address)
+            )
+            self.outbox.close()
+            self.disconnect()
 
     def setup(self):
         self.logger.debug("setup")
         socketserver.StreamRequestHandler.setup(self)
+        self.setup_send(flusher=False)  # the Outbox thread flushes
         self.model = self.server.model
         assert isinstance(self.model, Model)
-        self.send(1, json.dumps({"lang": "en", "version": "1.1.30.0"}).encode())
-        self.send_updates(self.model.dump(0, True))
-        self.model.register("update", self.listen_update)
-        self.model.register("map_update", self.listen_map_update)
+        self.outbox = Outbox()
+        self.replica = Replica(self.server.broadcast)
+        # an app that does not read must not hold this thread forever
+        self.request.settimeout(Keepalive.timeout or None)
+        try:
+            self.send(1, json.dumps({"lang": "en", "version": "1.1.30.0"}).encode())
+            self.__sync()
+        except OSError as e:
+            self.logger.warn(
+                "Sending the model to {} failed: {}".format(self.client_address, e)
+            )
+            self.outbox.close()
+            self.disconnect()
+            return
+        finally:
+            self.request.settimeout(None)
+        with self.send_lock:
+            self.server.broadcast.subscribe(self.listen_frame)
+            self.__sync()
+            self.flush()
+        thread = threading.Thread(target=self.__drain, name="Outbox")
+        thread.daemon = True
+        thread.start()
+        self.last_received = time.monotonic()  # nothing was read during the sync
+        Keepalive.shared().add(self)
 
     def finish(self):
         self.logger.debug("finish")
-        self.model.unregister("update", self.listen_update)
+        Keepalive.shared().remove(self)
+        self.server.broadcast.unsubscribe(self.listen_frame)
+        self.outbox.close()
+        self.close_send()
         socketserver.StreamRequestHandler.finish(self)
 
 
 class TCPServer(socketserver.ThreadingTCPServer):
+    broadcast: Broadcast
+
     def __init__(self, model):
         self.model = model
         socketserver.ThreadingTCPServer.__init__(self, ("", TCP_PORT), TCPServerHandler)
+        # once bound, a failed bind must not leave its listeners registered
+        self.broadcast = Broadcast(model)
 
     def server_activate(self):
         self.model.server["run_server"] = True
@@ -163,32 +801,238 @@ class TCPServer(socketserver.ThreadingTCPServer):
         self.model.server["run_server"] = False
         socketserver.ThreadingTCPServer.shutdown(self)
 
+    def server_close(self):
+        if hasattr(self, "broadcast"):  # not created if binding failed
+            self.broadcast.close()
+        socketserver.ThreadingTCPServer.server_close(self)
+
+
+class AsyncTCPSession(TCPHandler):
+    """
+    One app connected to an `AsyncTCPServer`. Packets to the app wait in its
+    `Outbox`.
+    """
+
+    logger = logging.getLogger("pipboy.AsyncTCPSession")
+
+    def __init__(self, model, broadcast, reader, writer):
+        self.model = model
+        self.broadcast = broadcast
+        self.reader = reader
+        self.writer = writer
+        self.outbox = Outbox()
+        self.replica = Replica(broadcast)
+        self.__ready = asyncio.Event()
+        self.last_sent = self.last_received = time.monotonic()
+
+    def put(self, frame):
+        """Queues frame, must be called from the event loop."""
+        if not self.outbox.put(frame):
+            if not self.outbox.closed:
+                self.logger.warn(
+                    "Disconnecting {}, it fell too far behind".format(
+                        self.writer.get_extra_info("peername")
+                    )
+                )
+                self.outbox.close()
+                self.writer.close()
+            return
+        self.__ready.set()
+
+    def send(self, channel, data):
+        self.put(Broadcast.frame(channel, data))
+
+    # commands are passed on to the game with blocking writes, in order
+    __commands = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="Command"
+    )
+
+    def dispatch(self, channel, data):
+        if channel == 5:
+            loop = asyncio.get_running_loop()
+            loop.run_in_executor(
+                AsyncTCPSession.__commands, TCPHandler.dispatch, self, channel, data
+            )
+        else:
+            TCPHandler.dispatch(self, channel, data)
+
+    async def __sync(self):
+        (size, chunks) = self.replica.sync()
+        if not size:
+            return
+        self.writer.write(struct.pack("<IB", size, 3))
+        for chunk in chunks:
+            self.writer.write(chunk)
+            await self.writer.drain()
+            self.last_sent = time.monotonic()
+            await asyncio.sleep(0)  # let the other sessions run
+
+    async def __send(self):
+        hello = json.dumps({"lang": "en", "version": "1.1.30.0"}).encode()
+        self.writer.write(Broadcast.frame(1, hello).data)
+        await self.__sync()
+        while True:
+            await self.__ready.wait()
+            self.__ready.clear()
+            for frame in self.outbox.take():
+                follows = self.replica.follows(frame)
+                if follows is None:
+                    await self.__sync()
+                elif follows:
+                    self.writer.write(frame.data)
+            await self.writer.drain()
+            self.last_sent = time.monotonic()
+
+    async def __receive(self):
+        while True:
+            (size, channel) = struct.unpack("<IB", await self.reader.readexactly(5))
+            data = await self.reader.readexactly(size)
+            self.last_received = time.monotonic()
+            self.dispatch(channel, data)
+
+    async def __keepalive(self):
+        """The event loop schedules the `Keepalive`s of all sessions."""
+        interval = Keepalive.interval
+        timeout = Keepalive.timeout
+        while True:
+            now = time.monotonic()
+            if timeout and now - self.last_received > timeout:
+                self.logger.warn(
+                    "Disconnecting {}, nothing received for {:.1f}s".format(
+                        self.writer.get_extra_info("peername"),
+                        now - self.last_received,
+                    )
+                )
+                return
+            if now - self.last_sent >= interval and not self.__ready.is_set():
+                self.send(0, b"")
+            deadline = self.last_sent + interval
+            if timeout:
+                deadline = min(deadline, self.last_received + timeout)
+            await asyncio.sleep(max(deadline - time.monotonic(), interval / 10))
+
+    async def run(self):
+        self.logger.debug("run")
+        sender = asyncio.ensure_future(self.__send())
+        receiver = asyncio.ensure_future(self.__receive())
+        keepalive = asyncio.ensure_future(self.__keepalive())
+        tasks = (sender, receiver, keepalive)
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception():
+                    error = task.exception()
+                    if not isinstance(error, (asyncio.IncompleteReadError, OSError)):
+                        self.logger.error("Session failed: %r" % error)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.writer.close()
+            self.logger.debug("finish")
+
+
+class AsyncTCPServer(object):
+    """
+    Serves apps from a single thread running an asyncio event loop, every app
+    is an `AsyncTCPSession`. Compatible with `TCPServer` for `ServerThread`.
+    """
+
+    logger = logging.getLogger("pipboy.AsyncTCPServer")
+
+    def __init__(self, model, port=TCP_PORT):
+        self.model = model
+        self.port = port
+        self.broadcast: Optional[Broadcast] = None
+        self.sessions = set()
+        self.__tasks = set()
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__stop: Optional[asyncio.Event] = None
+        self.__started = threading.Event()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.__started.set()
+
+    async def serve(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__stop = asyncio.Event()
+        server = await asyncio.start_server(self.__accept, "", self.port)
+        self.model.server["run_server"] = True
+        self.broadcast = Broadcast(self.model)
+        self.broadcast.subscribe(self.listen_frame)
+        self.__started.set()
+        try:
+            async with server:
+                await self.__stop.wait()
+        finally:
+            self.broadcast.close()
+            self.model.server["run_server"] = False
+            for session in list(self.sessions):
+                session.writer.close()
+            if self.__tasks:
+                await asyncio.wait(list(self.__tasks), timeout=1)
+
+    async def __accept(self, reader, writer):
+        broadcast = self.broadcast
+        assert broadcast is not None  # created before the loop accepts apps
+        session = AsyncTCPSession(self.model, broadcast, reader, writer)
+        if broadcast.map is not None:
+            session.put(broadcast.map)
+        task = asyncio.current_task()
+        self.sessions.add(session)
+        self.__tasks.add(task)
+        try:
+            await session.run()
+        finally:
+            self.sessions.discard(session)
+            self.__tasks.discard(task)
+
+    def __queue(self, frame):
+        for session in list(self.sessions):
+            session.put(frame)
+
+    def listen_frame(self, frame):
+        loop = self.__loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.__queue, frame)
+
+    def shutdown(self):
+        self.__started.wait()
+        (loop, stop) = (self.__loop, self.__stop)
+        if loop is None or stop is None:
+            return  # failed to start
+        try:
+            loop.call_soon_threadsafe(stop.set)
+        except RuntimeError:
+            pass  # not running anymore
+
+    def server_close(self):
+        pass
+
 
 class TCPClientHandler(TCPHandler, socketserver.StreamRequestHandler):
     logger = logging.getLogger("pipboy.TCPClientHandler")
     switch = "run_client"
 
-    def heartbeat(self):
-        while self.model.server[self.switch]:
-            self.logger.debug("heartbeat")
-            self.send(0, b"")
-            time.sleep(1)
-
     def listen_command(self, _type, args):
         self.send_command(_type, args)
 
     def setup(self):
         self.logger.debug("setup")
         socketserver.StreamRequestHandler.setup(self)
+        self.setup_send()
         self.model = self.server.model
+        self.synced = False
         self.model.register("command", self.listen_command)
-        thread = threading.Thread(target=self.heartbeat, name="Heartbeat")
-        thread.start()
+        Keepalive.shared().add(self)
 
     def finish(self):
         self.logger.debug("finish")
-        self.hb = False
+        Keepalive.shared().remove(self)
         self.model.unregister("command", self.listen_command)
+        self.close_send()
         socketserver.StreamRequestHandler.finish(self)
 
 
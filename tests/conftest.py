@@ -0,0 +1,20 @@
+import json
+import pathlib
+
+import pytest
+
+from pipboy.format import BuiltinFormat
+
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def world():
+    with open(ROOT / "world.json") as stream:
+        return json.load(stream)
+
+
+@pytest.fixture(scope="session")
+def items(world):
+    return BuiltinFormat.load(world)
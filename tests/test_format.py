@@ -0,0 +1,304 @@
+import io
+import json
+import struct
+import sys
+import zlib
+
+import pytest
+
+from pipboy.format import (
+    BuiltinFormat,
+    DictUpdate,
+    LocalMap,
+    PipboyFormat,
+    TCPDecoder,
+    TCPFormat,
+)
+from pipboy.mvc import Model
+
+
+def encode(items):
+    stream = io.BytesIO()
+    TCPFormat.dump(items, stream)
+    return stream.getvalue()
+
+
+@pytest.fixture(scope="module")
+def payload(items):
+    return encode(items)
+
+
+def test_loads_matches_load(items, payload):
+    assert TCPFormat.loads(payload) == items
+    assert TCPFormat.load(io.BytesIO(payload)) == items
+
+
+def test_loads_memoryview(items, payload):
+    assert TCPFormat.loads(memoryview(payload)) == items
+    assert TCPFormat.loads(memoryview(b"\x00" + payload)[1:]) == items
+
+
+@pytest.mark.parametrize(
+    "value",
+    [True, False, 0, -1, 2**31, -(2**31), 1.5, "", "Diamond City", [], [3, 4], {}],
+)
+def test_round_trip_values(value):
+    assert TCPFormat.loads(encode([[7, value]])) == [[7, value]]
+
+
+def test_dumps_matches_dump(items, payload):
+    assert bytes(TCPFormat.dumps(items)) == payload
+    assert TCPFormat.size(items) == len(payload)
+
+
+@pytest.mark.parametrize(
+    "entries",
+    [[], [[1, -129], [2, 128], [3, "Sanctuary Hills"]], [[4, "Ünïcødé"], [5, [6] * 9]]],
+)
+def test_dumps_entries(entries):
+    data = TCPFormat.dumps(entries)
+    assert type(data) == bytearray
+    assert bytes(data) == encode(entries)
+    assert TCPFormat.size(entries) == len(data)
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 4096])
+def test_decoder_chunks(items, payload, chunk):
+    decoder = TCPDecoder()
+    entries = []
+    for start in range(0, len(payload), chunk):
+        end = start + chunk
+        decoder.feed(payload[start:end])
+        entries += decoder.entries()
+    assert entries == items
+    assert decoder.pending == 0
+
+
+def test_decoder_partial_entry():
+    payload = encode([[1, "Nate"], [2, 3.5]])
+    decoder = TCPDecoder()
+    decoder.feed(payload[:-1])
+    assert decoder.entries() == [[1, "Nate"]]
+    assert decoder.pending == 8
+    decoder.feed(payload[-1:])
+    assert decoder.entries() == [[2, 3.5]]
+
+
+def test_decoder_stops_at_unknown_type():
+    decoder = TCPDecoder()
+    decoder.feed(encode([[1, "Nate"]]) + b"\x09" + bytes(8))
+    assert decoder.entries() == [[1, "Nate"]]
+    decoder.feed(encode([[2, "Codsworth"]]))
+    assert decoder.entries() == []
+    assert decoder.pending == 0
+
+
+def test_canonical_key():
+    assert PipboyFormat.canonical_key("playerinfo") == "PlayerInfo"
+    assert PipboyFormat.canonical_key("XPLEVEL") == "XPLevel"
+    assert PipboyFormat.canonical_key("sortedids") == "sortedIDS"
+    assert PipboyFormat.canonical_key("Unlisted") == "Unlisted"
+    assert PipboyFormat.canonical_key("MAP") is PipboyFormat.canonical_key("map")
+
+
+def test_pipboy_format_load():
+    def string(text):
+        return struct.pack("<I", len(text)) + text.encode()
+
+    data = (
+        struct.pack("<BII", 2, 0, 1)
+        + string("playerinfo")
+        + struct.pack("<BII", 2, 1, 1)
+        + string("playername")
+        + struct.pack("<BI", 0, 2)
+        + struct.pack("<B", 6)
+        + string("Nate")
+    )
+    items = PipboyFormat.load(io.BytesIO(data))
+    assert sorted(items, key=lambda entry: entry[0]) == [
+        [0, {"PlayerInfo": 1}],
+        [1, {"PlayerName": 2}],
+        [2, b"Nate"],
+    ]
+
+
+def test_pipboy_format_load_deep():
+    depth = sys.getrecursionlimit() * 2
+    data = struct.pack("<BII", 1, 0, 1)
+    for _id in range(1, depth):
+        data += struct.pack("<IBII", 0, 1, _id, 1)
+    data += struct.pack("<IBIBi", 0, 0, depth, 0, -7)
+    items = PipboyFormat.load(io.BytesIO(data))
+    assert items[0] == [depth, -7]
+    assert items[1:] == [[_id, [_id + 1]] for _id in range(depth - 1, -1, -1)]
+
+
+@pytest.fixture(scope="module")
+def world_model(items):
+    model = Model()
+    model.load(items)
+    return model
+
+
+def test_builtin_round_trip(world, world_model):
+    assert BuiltinFormat.dump_model(world_model) == world
+
+
+def test_builtin_load_deep():
+    depth = sys.getrecursionlimit() * 2
+    item = "Vault 111"
+    for _ in range(0, depth):
+        item = [item]
+    items = BuiltinFormat.load(item)
+    assert len(items) == depth + 1
+    assert items[0] == [depth, "Vault 111"]
+
+
+@pytest.mark.parametrize("indent", [4, None])
+@pytest.mark.parametrize("sort_keys", [True, False])
+def test_dump_json(world, world_model, indent, sort_keys):
+    stream = io.StringIO()
+    BuiltinFormat.dump_json(world_model, stream, indent=indent, sort_keys=sort_keys)
+    assert stream.getvalue() == json.dumps(world, indent=indent, sort_keys=sort_keys)
+
+
+def test_dump_json_defaults(world, world_model):
+    stream = io.StringIO()
+    BuiltinFormat.dump_json(world_model, stream)
+    assert stream.getvalue() == json.dumps(world, indent=4, sort_keys=True)
+
+
+def test_dump_json_cycle(world_model):
+    _id = world_model.get_id("$.Status.EffectColor")
+    world_model.update([[_id, [_id]]])
+    with pytest.raises(ValueError):
+        BuiltinFormat.dump_json(world_model, io.StringIO())
+
+
+def test_dict_update_round_trip():
+    update = DictUpdate({"a": 1, "b": 2}, removed=[3])
+    (entry,) = TCPFormat.loads(bytes(TCPFormat.dumps([[9, update]])))
+    assert entry == [9, {"a": 1, "b": 2}]
+    assert entry[1].removed == [3]
+
+
+def test_dict_update_merge_and_diff():
+    previous = {"a": 1, "b": 2, "c": 3}
+    value = {"a": 1, "c": 4, "d": 5}
+    update = DictUpdate.diff(previous, value)
+    assert update == {"c": 4, "d": 5}
+    assert update.removed == [2]
+    assert update.merge(previous) == value
+    assert DictUpdate({"x": 1}).merge(None) == {"x": 1}
+
+
+def test_dict_update_shared_reference():
+    previous = {"a": 1, "b": 1}
+    update = DictUpdate.diff(previous, {"a": 1})
+    assert update.merge(previous) == {"a": 1}
+
+
+@pytest.mark.parametrize("refs", [[], [0], list(range(0, 65535)), [0xFFFFFFFF, 1]])
+def test_list_round_trip(refs):
+    data = encode([[3, refs], [4, DictUpdate({"a": 1}, removed=refs)]])
+    for (_, value), (_, update) in (
+        TCPFormat.loads(data),
+        TCPFormat.load(io.BytesIO(data)),
+    ):
+        assert type(value) == list
+        assert value == refs
+        assert update.removed == refs
+
+
+def test_truncated_list():
+    data = encode([[3, [1, 2, 3]]])[:-2]
+    with pytest.raises(struct.error):
+        TCPFormat.loads(data)
+    with pytest.raises(struct.error):
+        TCPFormat.load(io.BytesIO(data))
+
+
+def map_data(width, height, pixels, extents=(-1.5, 2.0, 3.5, 2.0, -1.5, -4.0)):
+    return struct.pack("<II6f", width, height, *extents) + bytes(pixels)
+
+
+@pytest.fixture()
+def gradient():
+    pixels = [(x + 3 * y) % 256 for y in range(0, 40) for x in range(0, 64)]
+    return LocalMap(map_data(64, 40, pixels))
+
+
+def test_local_map_header(gradient):
+    assert (gradient.width, gradient.height) == (64, 40)
+    assert gradient.nw == (-1.5, 2.0)
+    assert gradient.ne == (3.5, 2.0)
+    assert gradient.sw == (-1.5, -4.0)
+    assert gradient.tiles() == [(0, 0), (1, 0), (0, 1), (1, 1)]
+    assert gradient.changed == gradient.tiles()
+
+
+def test_local_map_pixels(gradient):
+    assert type(gradient.pixels) == memoryview
+    assert gradient.pixels.obj is gradient.data
+    assert len(gradient.pixels) == 64 * 40
+    assert list(gradient.row(2)) == [(x + 6) % 256 for x in range(0, 64)]
+    interface = gradient.__array_interface__
+    assert interface["shape"] == (40, 64)
+    assert interface["typestr"] == "|u1"
+    assert interface["data"] == gradient.pixels
+
+
+def test_local_map_numpy(gradient):
+    numpy = pytest.importorskip("numpy")
+    array = numpy.asarray(gradient)
+    assert array.shape == (40, 64)
+    assert array[2, 5] == 11
+
+
+@pytest.mark.parametrize("size", [0, 10, 32 + 64 * 40 - 1])
+def test_local_map_short_packet(size):
+    data = map_data(64, 40, bytes(64 * 40))[:size]
+    with pytest.raises((ValueError, struct.error)):
+        LocalMap(data)
+
+
+def test_local_map_diff(gradient):
+    pixels = bytearray(gradient.pixels)
+    assert LocalMap(map_data(64, 40, pixels)).diff(gradient) == []
+    pixels[35 * 64 + 40] ^= 0xFF
+    pixels[3] ^= 0xFF
+    assert LocalMap(map_data(64, 40, pixels)).diff(gradient) == [(0, 0), (1, 1)]
+    collision = LocalMap(map_data(64, 40, pixels))
+    collision.checksum = gradient.checksum
+    assert collision.diff(gradient) == [(0, 0), (1, 1)]
+    moved = LocalMap(map_data(64, 40, gradient.pixels, extents=(0,) * 6))
+    assert moved.diff(gradient) == moved.tiles()
+    assert gradient.diff(None) == gradient.tiles()
+
+
+def test_local_map_downsample(gradient):
+    small = gradient.downsample(3)
+    assert (small.width, small.height) == (22, 14)
+    assert (small.nw, small.ne, small.sw) == (gradient.nw, gradient.ne, gradient.sw)
+    assert list(small.row(1)) == list(gradient.row(3))[::3]
+    assert bytes(gradient.downsample_async(3).result().pixels) == bytes(small.pixels)
+
+
+def test_local_map_png(gradient):
+    png = gradient.to_png()
+    assert png[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks = {}
+    offset = 8
+    while offset < len(png):
+        (size, typ) = struct.unpack_from(">I4s", png, offset)
+        start = offset + 8
+        end = start + size
+        (crc,) = struct.unpack_from(">I", png, end)
+        assert crc == zlib.crc32(typ + png[start:end])
+        chunks[typ] = png[start:end]
+        offset = end + 4
+    assert list(chunks) == [b"IHDR", b"IDAT", b"IEND"]
+    assert struct.unpack(">IIBBBBB", chunks[b"IHDR"]) == (64, 40, 8, 0, 0, 0, 0)
+    rows = [b"\x00" + gradient.row(y) for y in range(0, 40)]
+    assert zlib.decompress(chunks[b"IDAT"]) == b"".join(rows)
+    assert gradient.to_png_async().result() == png
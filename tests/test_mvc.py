@@ -0,0 +1,428 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from pipboy.format import DictUpdate
+from pipboy.mvc import Dispatcher, Model, PathTrie
+
+
+@pytest.fixture()
+def model(items):
+    model = Model()
+    model.load(items)
+    return model
+
+
+def test_update_notifies(model):
+    received = []
+    model.register("update", received.append)
+    _id = model.get_id("$.PlayerInfo.PlayerName")
+    model.update([[_id, "Nate"]])
+    assert received == [[_id]]
+    assert model.get_item(_id) == "Nate"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class Slow(object):
+    """Update listener recording its batches, blocked until released."""
+
+    def __init__(self):
+        self.batches = []
+        self.threads = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, changed):
+        self.threads.append(threading.current_thread().name)
+        self.entered.set()
+        self.release.wait(5)
+        self.batches.append(changed)
+
+
+@pytest.fixture()
+def dispatcher(model):
+    model.dispatcher = Dispatcher()
+    yield model.dispatcher
+    model.dispatcher.stop()
+
+
+def test_dispatcher_merges_repeated_ids(model, dispatcher):
+    (a, b, c) = [
+        model.get_id(path)
+        for path in ["$.PlayerInfo.Caps", "$.PlayerInfo.CurrHP", "$.Status.IsInVats"]
+    ]
+    slow = Slow()
+    model.register("update", slow)
+    model.update([[a, 1]])
+    assert slow.entered.wait(5)
+    model.update([[b, 2]])
+    model.update([[a, 3]])
+    model.update([[c, True], [b, 4]])
+    slow.release.set()
+    wait_for(lambda: len(slow.batches) == 2)
+    assert slow.batches == [[a], [b, a, c]]
+    assert all(name.startswith("Dispatch-") for name in slow.threads)
+    (stats,) = dispatcher.stats().values()
+    assert stats["listener"] == repr(slow)
+    assert (stats["depth"], stats["max_depth"]) == (0, 3)
+    assert (stats["received"], stats["merged"], stats["delivered"]) == (5, 1, 4)
+    assert stats["batches"] == 2
+    assert 0 < stats["mean_latency"] <= stats["max_latency"]
+
+
+def test_slow_listener_holds_up_nothing(model, dispatcher):
+    _id = model.get_id("$.PlayerInfo.Caps")
+    slow = Slow()
+    seen = []
+    model.register("update", slow)
+    model.register("update", lambda changed: seen.append(model.get_item(_id)))
+    model.update([[_id, 0]])
+    assert slow.entered.wait(5)
+    start = time.monotonic()
+    for caps in range(1, 100):
+        model.update([[_id, caps]])
+    assert time.monotonic() - start < 1
+    wait_for(lambda: seen and seen[-1] == 99)
+    assert slow.batches == []
+    slow.release.set()
+    wait_for(lambda: len(slow.batches) == 2)
+    assert slow.batches == [[_id], [_id]]
+
+
+def test_dispatcher_remove_and_stop(model, dispatcher):
+    _id = model.get_id("$.PlayerInfo.Caps")
+    received = []
+    model.register("update", received.append)
+    model.update([[_id, 1]])
+    wait_for(lambda: received == [[_id]])
+    (name,) = dispatcher.stats()
+    model.unregister("update", received.append)
+    assert dispatcher.stats() == {}
+    wait_for(lambda: name not in [thread.name for thread in threading.enumerate()])
+    model.register("update", received.append)
+    dispatcher.stop()
+    model.update([[_id, 2]])
+    assert received == [[_id], [_id]]
+    assert dispatcher.stats() == {}
+
+
+def test_paths(model):
+    for _id, _ in model.walk():
+        assert model.get_path(_id) == "$" + "".join(model.get_segments(_id))
+    assert model.get_path(0) == "$"
+    with pytest.raises(KeyError):
+        model.get_path(20001)
+
+
+def test_get_id(model):
+    for _id, _ in model.walk():
+        assert model.get_id(model.get_path(_id)) == _id
+    name = model.get_id("$.PlayerInfo.PlayerName")
+    assert model.get_id("$.playerinfo.PLAYERNAME") == name
+    assert model.get_id("$") == 0
+    for path in ["$.Nowhere", "$.PlayerInfo[0]", "$.Log[100000]", "Log", "$.Log."]:
+        assert model.get_id(path) is None
+
+
+def test_get_id_after_keys_change(model):
+    info = model.get_id("$.PlayerInfo")
+    assert model.get_id("$.playerinfo.nickname") is None
+    model.update([[20001, "Nate"], [info, dict(model.get_item(info), NickName=20001)]])
+    assert model.get_id("$.playerinfo.nickname") == 20001
+
+
+def test_moved_subtree_path_is_invalidated(model):
+    info = model.get_id("$.PlayerInfo")
+    name = model.get_id("$.PlayerInfo.PlayerName")
+    assert model.get_path(name) == "$.PlayerInfo.PlayerName"
+    root = dict(model.get_item(0), Info=info, PlayerInfo=20001)
+    model.update([[20001, {}], [0, root]])
+    assert model.get_path(info) == "$.Info"
+    assert model.get_path(name) == "$.Info.PlayerName"
+    assert model.get_path(20001) == "$.PlayerInfo"
+
+
+def test_only_container_paths_are_cached(model):
+    info = model.get_id("$.PlayerInfo")
+    name = model.get_id("$.PlayerInfo.PlayerName")
+    assert model.get_path(name) == "$.PlayerInfo.PlayerName"
+    cached = model._Model__paths
+    assert info in cached and name not in cached
+    model.update([[20001, "Nate"], [name, {"First": 20001}]])
+    assert model.get_path(20001) == "$.PlayerInfo.PlayerName.First"
+    assert name in cached and 20001 not in cached
+    root = dict(model.get_item(0), Info=info, PlayerInfo=20002)
+    model.update([[20002, {}], [0, root]])
+    assert model.get_path(20001) == "$.Info.PlayerName.First"
+
+
+def test_get_path_waits_for_update(model):
+    _id = model.get_id("$.PlayerInfo.PlayerName")
+    info = model.get_id("$.PlayerInfo")
+    paths = []
+    with model.lock:
+        reader = threading.Thread(target=lambda: paths.append(model.get_path(_id)))
+        reader.start()
+        reader.join(0.2)
+        assert reader.is_alive()
+        root = dict(model.get_item(0), Renamed=20001)
+        model.update([[20001, {"Name": _id}], [info, {}], [0, root]])
+    reader.join()
+    assert paths == ["$.Renamed.Name"]
+    assert model.get_id("$.renamed.NAME") == _id
+
+
+def test_subscription(model):
+    received = []
+    model.register("update", received.append, path="$.PlayerInfo")
+    name = model.get_id("$.PlayerInfo.PlayerName")
+    model.update([[name, "Nate"], [model.get_id("$.Status.IsInVats"), True]])
+    assert received == [[name]]
+
+
+def test_subscription_patterns(model):
+    received = []
+    model.register("update", received.append, path="$.Status.*")
+    vats = model.get_id("$.Status.IsInVats")
+    model.update([[vats, True], [model.get_id("$.PlayerInfo.Caps"), 5]])
+    model.unregister("update", received.append, path="$.Status.*")
+    model.update([[vats, False]])
+    assert received == [[vats]]
+    assert len(model.subscriptions) == 0
+
+
+def test_path_trie():
+    trie = PathTrie(["$.Map.Local", "$.Inventory.*[*]"])
+    assert len(trie) == 2
+    assert trie.match(PathTrie.segments("$.Map.Local.Player.X")) == ["$.Map.Local"]
+    assert trie.match(PathTrie.segments("$.Map.Local.Player.X"), prefix=False) == []
+    assert trie.match(PathTrie.segments("$.inventory.Weapons[3]"), prefix=False) == [
+        "$.Inventory.*[*]"
+    ]
+    trie.remove("$.Map.Local", "$.Map.Local")
+    assert len(trie) == 1
+
+
+def test_dict_update_is_merged(model):
+    info = model.get_id("$.PlayerInfo")
+    caps = model.get_id("$.PlayerInfo.Caps")
+    value = model.get_item(info)
+    model.update([[20001, "Nate"], [info, DictUpdate({"Nick": 20001}, [caps])]])
+    expected = dict(value, Nick=20001)
+    del expected["Caps"]
+    assert model.get_item(info) == expected
+    assert type(model.get_item(info)) == dict
+    assert model.get_item(caps) is None
+    assert model.get_path(20001) == "$.PlayerInfo.Nick"
+
+
+def test_replaced_subtree_is_collected(model):
+    _id = model.get_id("$.Inventory")
+    dropped = model.get_item(_id)
+    before = model.collected["entries"]
+    model.update([[_id, {}]])
+    for child in dropped.values():
+        assert model.get_item(child) is None
+        with pytest.raises(KeyError):
+            model.get_path(child)
+    assert model.collected["entries"] > before
+    assert model.collect(full=True) == (0, 0)
+
+
+def test_moved_child_is_kept(model):
+    (a, b) = (20001, 20002)
+    model.update([[a, "a"], [b, []], [0, dict(model.get_item(0), Extra=b)]])
+    model.update([[b, [a]]])
+    assert model.get_path(a) == "$.Extra[0]"
+    model.update([[b, []], [0, dict(model.get_item(0), Moved=a)]])
+    assert model.get_item(a) == "a"
+    assert model.get_path(a) == "$.Moved"
+
+
+def test_full_collection(model):
+    before = len(model.dump(0, True))
+    model.update([[20001, []], [20002, [20001]], [20003, "loose"]])
+    model.apply([[20001, [20002]]])
+    assert model.collect() == (0, 0)
+    (entries, size) = model.collect(full=True)
+    assert entries == 3
+    assert size > 0
+    assert len(model.dump(0, True)) == before
+
+
+def test_snapshot_matches_model(model):
+    snapshot = model.snapshot()
+    assert snapshot.dump(0, True) == model.dump(0, True)
+    for _id, value in model.walk():
+        path = model.get_path(_id)
+        assert snapshot.get_item(_id) == value
+        assert snapshot.get_path(_id) == path
+        assert snapshot.get_segments(_id) == model.get_segments(_id)
+        assert snapshot.get_id(path) == _id
+        assert snapshot.get_id(path.upper()) == model.get_id(path.upper())
+    for path in ["$.Nowhere", "$.PlayerInfo[0]", "$.Log[100000]", "Log", "$.Log."]:
+        assert snapshot.get_id(path) is None
+
+
+def test_snapshot_is_immutable(model):
+    _id = model.get_id("$.PlayerInfo.PlayerName")
+    snapshot = model.snapshot()
+    value = snapshot.get_item(_id)
+    model.update([[_id, "Changed"]])
+    assert snapshot.get_item(_id) == value
+    assert model.snapshot().get_item(_id) == "Changed"
+    assert model.snapshot().version == snapshot.version + 1
+
+
+def test_snapshot_keeps_moved_paths(model):
+    info = model.get_id("$.PlayerInfo")
+    snapshot = model.snapshot()
+    model.update(
+        [[0, dict(model.get_item(0), Info=info, PlayerInfo=20001)], [20001, {}]]
+    )
+    assert snapshot.get_path(info) == "$.PlayerInfo"
+    assert snapshot.get_id("$.PlayerInfo") == info
+    assert snapshot.get_id("$.Info") is None
+    assert model.snapshot().get_path(info) == "$.Info"
+    assert model.snapshot().get_id("$.PlayerInfo") == 20001
+
+
+def test_changed_and_collected_in_one_update(model):
+    from pipboy.mvc import View
+
+    view = View(model)
+    view.should_spam = False
+    received = []
+    model.register("update", received.append)
+    info = model.get_id("$.PlayerInfo")
+    old = model.get_id("$.PlayerInfo.PlayerName")
+    new = 20001
+    value = dict(model.get_item(info), PlayerName=new)
+    model.update([[old, "Old"], [new, "New"], [info, value]])
+    assert received == [[new, info]]
+    assert model.get_path(new) == "$.PlayerInfo.PlayerName"
+
+
+def test_gc_publishes(model):
+    _id = 20001
+    model.update([[_id, "unreachable"]])
+    version = model.version
+    assert model.snapshot().get_item(_id) == "unreachable"
+    (entries, _) = model.gc()
+    assert entries == 1
+    assert model.get_item(_id) is None
+    assert model.snapshot().get_item(_id) is None
+    assert model.version == version + 1
+    assert model.gc() == (0, 0)
+
+
+def local_map(fill):
+    from pipboy.format import LocalMap
+
+    header = struct.pack("<II6f", 4, 4, 0, 0, 1, 0, 0, 1)
+    return LocalMap(header + bytes([fill]) * 16)
+
+
+def test_map_request_is_answered(model):
+    received = []
+    model.register("map_update", received.append)
+    model.map_update(local_map(1))
+    model.map_update(local_map(1))
+    assert len(received) == 1
+    model.command(model.map_request, [])
+    model.map_update(local_map(1))
+    assert len(received) == 2
+    assert model.local_map is received[-1]
+
+
+def test_changes_since(model):
+    name = model.get_id("$.PlayerInfo.PlayerName")
+    level = model.get_id("$.PlayerInfo.XPLevel")
+    seq = model.version
+    model.update([[name, "A"]])
+    model.update([[level, 7]])
+    model.update([[name, "B"]])
+    (snapshot, entries) = model.changes_since(seq)
+    assert snapshot is model.snapshot()
+    assert entries == [[level, 7], [name, "B"]]
+    assert model.changes_since(model.version) == (snapshot, [])
+    assert model.changes_since(model.version + 1) is None
+
+
+def test_changes_since_beyond_journal(model):
+    _id = model.get_id("$.PlayerInfo.PlayerName")
+    seq = model.version
+    for count in range(0, model.journal_size + 1):
+        model.update([[_id, str(count)]])
+    assert model.changes_since(seq) is None
+
+
+def test_changes_since_after_clear(model):
+    seq = model.version
+    model.load([[0, {}]])
+    assert model.changes_since(seq) is None
+    assert model.changes_since(model.version) == (model.snapshot(), [])
+
+
+def test_changes_since_large_update(model, items):
+    seq = model.version
+    model.update([[_id, v] for _id, v in items if type(v) not in (list, dict)])
+    (_, entries) = model.changes_since(seq)
+    assert len(entries) > model.journal_size
+
+
+def test_dump_matches_items(model, items):
+    assert sorted(model.dump(0, True)) == sorted(items)
+    (entry,) = model.dump(items[0][0])
+    assert entry == items[0]
+    for _id in [-1, 20001, 1 << 40]:
+        assert model.get_item(_id) is None
+        with pytest.raises(KeyError):
+            model.dump(_id)
+
+
+def test_walk_skips_missing_children(model):
+    root = dict(model.get_item(0), Sparse=20001)
+    model.update([[20001, [20002, 20003]], [20003, "there"], [0, root]])
+    assert model.dump(20001, True) == [[20003, "there"], [20001, [20002, 20003]]]
+    assert model.get_item(20002) is None
+
+
+def test_walk_ends_at_cycles(model, caplog):
+    from pipboy.format import TCPFormat
+    from pipboy.tcp import Broadcast, Replica
+
+    _id = model.get_id("$.Status.EffectColor")
+    model.update([[_id, [_id]]])
+    assert model.dump(_id, True) == [[_id, [_id]]]
+    assert model.snapshot().dump(_id, True) == [[_id, [_id]]]
+    assert "Skipping id %d" % _id in caplog.text
+    size = len(model.dump(0, True))
+    broadcast = Broadcast(model)
+    (length, chunks) = Replica(broadcast).sync()
+    data = b"".join(chunks)
+    assert len(data) == length
+    assert len(TCPFormat.loads(data)) == size
+    broadcast.close()
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [[4000000000, "far"], [1.5, "float"], [-1, "negative"], [20001, [4000000000]]],
+)
+def test_invalid_ids_are_ignored(model, entry):
+    size = len(model.dump(0, True))
+    model.update([entry, [20002, [1.5, 2]], [20003, {"a": -1}], [20004, "kept"]])
+    assert model.get_item(20004) == "kept"
+    assert model.get_item(20001) is None
+    assert model.get_item(20002) is None
+    assert model.get_item(20003) is None
+    assert len(model.snapshot().dump(0, True)) == size
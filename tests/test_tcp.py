@@ -0,0 +1,576 @@
+import json
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import pipboy.tcp
+
+from pipboy.console import ServerThread
+from pipboy.format import LocalMap, TCPFormat
+from pipboy.mvc import Model
+from pipboy.tcp import (
+    AsyncTCPServer,
+    Broadcast,
+    Keepalive,
+    Outbox,
+    Replica,
+    TCPHandler,
+    TCPServer,
+    TCPServerHandler,
+)
+
+
+def test_subscriber_gets_latest_map():
+    model = Model()
+    broadcast = Broadcast(model)
+    data = struct.pack("<II6f", 2, 2, 0, 0, 1, 0, 0, 1) + bytes(4)
+    model.map_update(LocalMap(data))
+    frames = []
+    broadcast.subscribe(frames.append)
+    assert [frame.channel for frame in frames] == [4]
+    assert frames[0].data[5:] == data
+    late = Broadcast(model)
+    assert late.map.data == frames[0].data
+    broadcast.close()
+    late.close()
+
+
+def test_load_is_broadcast(items, caplog):
+    model = Model()
+    broadcast = Broadcast(model)
+    frames = []
+    broadcast.subscribe(frames.append)
+    model.load(items)
+    assert "Journal exceeded" not in caplog.text
+    ((channel, data, since, snapshot),) = frames
+    assert (channel, since, snapshot.version) == (3, 1, 2)
+    assert len(TCPFormat.loads(data[5:])) == len(items)
+    broadcast.close()
+
+
+def test_empty_gc_is_not_broadcast(items):
+    model = Model()
+    model.load(items)
+    broadcast = Broadcast(model)
+    frames = []
+    broadcast.subscribe(frames.append)
+    version = model.version
+    assert model.gc() == (0, 0)
+    assert model.version == version
+    model.update([[20001, "unreachable"]])
+    (entries, _) = model.gc()
+    assert entries == 1
+    assert [frame.channel for frame in frames] == [3]
+    broadcast.close()
+
+
+def entries(model):
+    return sorted(model.dump(0, True), key=lambda entry: entry[0])
+
+
+def test_replica(items, caplog):
+    model = Model()
+    model.load(items)
+    broadcast = Broadcast(model)
+    frames = []
+    broadcast.subscribe(frames.append)
+    replica = Replica(broadcast)
+    app = Model()
+    (size, chunks) = replica.sync()
+    data = b"".join(chunks)
+    assert len(data) == size
+    app.load(TCPFormat.loads(data))
+    assert entries(app) == entries(model)
+    caps = model.get_id("$.PlayerInfo.Caps")
+    model.update([[caps, 1]])
+    model.update([[caps, 2]])
+    (first, second) = frames
+    assert replica.follows(second) is None
+    (size, chunks) = replica.sync()
+    assert TCPFormat.loads(b"".join(chunks)) == [[caps, 2]]
+    assert replica.follows(first) is False
+    assert replica.follows(second) is False
+    assert replica.sync() == (0, [])
+    model.update([[caps, 3]])
+    assert replica.follows(frames[-1]) is True
+    assert replica.snapshot is frames[-1].snapshot
+    assert replica.follows(Broadcast.frame(1, b"{}")) is True
+    model.journal_size = 1
+    info = model.get_id("$.PlayerInfo")
+    model.update([[caps, 4]])
+    model.update([[20001, "Nate"], [info, dict(model.get_item(info), Nick=20001)]])
+    (size, chunks) = replica.sync()
+    assert "Changes since the last update were lost" in caplog.text
+    data = b"".join(chunks)
+    assert len(data) == size
+    app.update(TCPFormat.loads(data))
+    assert entries(app)[-1] == [20001, "Nate"]
+    assert entries(app) == entries(model)
+    broadcast.close()
+
+
+@pytest.fixture()
+def server(monkeypatch):
+    monkeypatch.setattr(pipboy.tcp, "TCP_PORT", 0)
+    monkeypatch.setattr(Keepalive, "timeout", 0.5)
+    model = Model()
+    server = TCPServer(model)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_failed_bind_leaves_no_listener(server, monkeypatch):
+    model = server.model
+    listeners = list(model.listener["update"])
+    monkeypatch.setattr(pipboy.tcp, "TCP_PORT", server.server_address[1])
+    with pytest.raises(OSError):
+        TCPServer(model)
+    assert model.listener["update"] == listeners
+
+
+class App(object):
+    """Reads every packet the server sends and answers with keepalives."""
+
+    def __init__(self, port, talk=True):
+        for _ in range(0, 50):
+            try:
+                self.sock = socket.create_connection(("127.0.0.1", port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)  # still starting
+        self.packets = []
+        self.closed = threading.Event()
+        threading.Thread(target=self.__read, daemon=True).start()
+        if talk:
+            threading.Thread(target=self.__talk, daemon=True).start()
+
+    def __read(self):
+        stream = self.sock.makefile("rb")
+        while True:
+            header = stream.read(5)
+            if len(header) < 5:
+                break
+            (size, channel) = struct.unpack("<IB", header)
+            self.packets.append((channel, stream.read(size)))
+        self.closed.set()
+
+    def __talk(self):
+        while not self.closed.wait(0.1):
+            try:
+                self.sock.sendall(struct.pack("<IB", 0, 0))
+            except OSError:
+                return
+
+    def wait(self, channel, count=1, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            packets = [data for _channel, data in self.packets if _channel == channel]
+            if len(packets) >= count:
+                return packets
+            time.sleep(0.01)
+        raise AssertionError("%d packets on channel %d expected" % (count, channel))
+
+    def close(self):
+        self.closed.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # disconnected already
+        self.sock.close()
+
+
+def test_sync_streams_the_model(server, items, monkeypatch):
+    monkeypatch.setattr(Replica, "sync_batch", 100)
+    server.model.load(items)
+    app = App(server.server_address[1])
+    (data,) = app.wait(3)
+    app.close()
+    entries = sorted(TCPFormat.loads(data), key=lambda entry: entry[0])
+    assert entries == sorted(server.model.dump(0, True), key=lambda entry: entry[0])
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture(params=["threaded", "async"])
+def serving(request, items, monkeypatch):
+    """A model served by either server, and the port of the server."""
+    port = free_port()
+    monkeypatch.setattr(pipboy.tcp, "TCP_PORT", port)
+    model = Model()
+    model.load(items)
+    if request.param == "threaded":
+        server = ServerThread(model, TCPServer)
+    else:
+        server = ServerThread(model, lambda model: AsyncTCPServer(model, port=port))
+    server.start()
+    yield (model, port)
+    server.stop()
+
+
+def test_app_follows_updates(serving):
+    (model, port) = serving
+    app = App(port)
+    (data,) = app.wait(3)
+    mirror = Model()
+    mirror.load(TCPFormat.loads(data))
+    assert entries(mirror) == entries(model)
+    caps = model.get_id("$.PlayerInfo.Caps")
+    info = model.get_id("$.PlayerInfo")
+    model.update([[caps, 1]])
+    model.update([[20001, "Nate"], [info, dict(model.get_item(info), Nick=20001)]])
+    value = dict(model.get_item(info))
+    del value["Caps"]
+    model.update([[info, value]])
+    applied = 1
+    while entries(mirror) != entries(model):
+        packets = app.wait(3, applied + 1)
+        for data in packets[applied:]:
+            mirror.update(TCPFormat.loads(data))
+        applied = len(packets)
+    assert mirror.get_item(caps) is None
+    assert not app.closed.is_set()
+    app.close()
+
+
+def test_stalled_sync_is_disconnected(server):
+    model = server.model
+    model.update([[100000, "x" * (16 << 20)], [0, dict(model.get_item(0), Big=100000)]])
+    sock = socket.create_connection(("127.0.0.1", server.server_address[1]))
+    time.sleep(1.5)
+    sock.settimeout(5)
+    received = 0
+    while True:
+        data = sock.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+    sock.close()
+    assert received < TCPFormat.size(model.dump(0, True))
+
+
+def test_kicked_app_leaves_the_others_connected(server):
+    model = server.model
+    port = server.server_address[1]
+    healthy = App(port)
+    healthy.wait(3)
+    model.update([[100000, "x" * (16 << 20)], [0, dict(model.get_item(0), Big=100000)]])
+    healthy.wait(3, 2)
+    with socket.create_connection(("127.0.0.1", port)) as stalled:
+        time.sleep(1.5)  # its sync times out, the healthy app keeps talking
+        stalled.settimeout(5)
+        while stalled.recv(1 << 20):
+            pass
+    assert model.server["run_server"]
+    model.update([[100001, "y"], [0, dict(model.get_item(0), Small=100001)]])
+    healthy.wait(3, 3)
+    late = App(port)
+    late.wait(3)
+    time.sleep(0.5)
+    assert not healthy.closed.is_set()
+    assert not late.closed.is_set()
+    healthy.close()
+    late.close()
+
+
+def test_timed_out_app_leaves_the_others_connected(server):
+    port = server.server_address[1]
+    healthy = App(port)
+    silent = App(port, talk=False)
+    assert silent.closed.wait(5)
+    time.sleep(0.5)
+    assert server.model.server["run_server"]
+    assert not healthy.closed.is_set()
+    healthy.close()
+    silent.close()
+
+
+class Handler(TCPHandler):
+    def __init__(self, request, flusher=True):
+        self.request = request
+        self.client_address = request.getsockname()
+        self.setup_send(flusher)
+
+
+@pytest.fixture()
+def pair():
+    (ours, theirs) = socket.socketpair()
+    yield (Handler(ours), theirs)
+    ours.close()
+    theirs.close()
+
+
+def test_stalled_update_leaves_the_model_unlocked(pair, items):
+    (handler, theirs) = pair
+    handler.model = model = Model()
+    model.load(items)
+    handler.rfile = handler.request.makefile("rb")
+    info = model.get_id("$.PlayerInfo")
+    child = TCPFormat.dumps([[20001, "Nate"]])
+    parent = TCPFormat.dumps([[info, dict(model.get_item(info), Nick=20001)]])
+    thread = threading.Thread(
+        target=handler._TCPHandler__stream_update, args=(len(child + parent),)
+    )
+    thread.start()
+    theirs.sendall(child)
+    for _ in range(0, 100):
+        if model.get_item(20001) is not None:
+            break
+        time.sleep(0.01)
+    assert model.lock.acquire(timeout=1)
+    model.lock.release()
+    assert model.gc() == (0, 0)  # the parent is still to come
+    theirs.sendall(parent)
+    thread.join(5)
+    assert model.get_path(20001) == "$.PlayerInfo.Nick"
+    handler.rfile.close()
+
+
+def server_handler(request):
+    """A `TCPServerHandler` on request, without a server."""
+    handler = TCPServerHandler.__new__(TCPServerHandler)
+    handler.request = request
+    handler.client_address = request.getsockname()
+    handler.outbox = Outbox()
+    handler.replica = Replica(None)
+    handler.setup_send(flusher=False)
+    return handler
+
+
+def test_overflowing_app_is_disconnected_once(monkeypatch, caplog):
+    monkeypatch.setattr(Outbox, "limit", 1)
+    (ours, theirs) = socket.socketpair()
+    handler = server_handler(ours)
+    for _ in range(0, 3):
+        handler.listen_frame(Broadcast.frame(1, b"{}"))
+    assert caplog.text.count("fell too far behind") == 1
+    assert not handler.connected
+    assert theirs.recv(1) == b""
+    ours.close()
+    theirs.close()
+
+
+def test_failed_send_disconnects():
+    (ours, theirs) = socket.socketpair()
+    theirs.close()
+    handler = server_handler(ours)
+    handler.outbox.put(Broadcast.frame(1, b"{}"))
+    thread = threading.Thread(target=handler._TCPServerHandler__drain)
+    thread.start()
+    thread.join(5)
+    assert handler.outbox.closed
+    assert not handler.connected
+    ours.close()
+
+
+@pytest.mark.parametrize("lock", ["send_lock", "_TCPHandler__condition"])
+def test_keepalive_skips_busy_sender(pair, lock):
+    (handler, _) = pair
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with getattr(handler, lock):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    start = time.monotonic()
+    assert handler.keepalive() is False
+    assert time.monotonic() - start < 0.5
+    release.set()
+    thread.join()
+    assert handler.keepalive() is True
+    assert handler.sent["frames"] == 1
+
+
+class Trickle(object):
+    """Socket that takes two bytes per send, like one whose peer stalls."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, data, flags=0):
+        return self.sock.send(data[:2], flags)
+
+    def sendmsg(self, buffers):
+        return self.sock.send(b"".join(buffers)[:2])
+
+
+def test_partial_keepalive_is_finished_later(pair):
+    (handler, peer) = pair
+    handler.request = Trickle(handler.request)
+    assert handler.keepalive() is False
+    assert handler.keepalive() is False
+    handler.send(1, b"{}")
+    expected = struct.pack("<IB", 0, 0) + struct.pack("<IB", 2, 1) + b"{}"
+    peer.settimeout(2)
+    received = b""
+    while len(received) < len(expected):
+        received += peer.recv(64)
+    assert received == expected
+    assert handler.sent["bytes"] == len(expected)
+    assert handler.sent["frames"] == 2
+
+
+def test_keepalive_to_full_socket_returns(pair):
+    (handler, _) = pair
+    handler.request.setblocking(False)
+    for size in (65536, 1):
+        try:
+            while True:
+                handler.request.send(bytes(size))
+        except BlockingIOError:
+            pass
+    handler.request.setblocking(True)
+    start = time.monotonic()
+    assert handler.keepalive() is False
+    assert time.monotonic() - start < 0.5
+
+
+def test_keepalive_scheduler(pair, monkeypatch):
+    (handler, peer) = pair
+    monkeypatch.setattr(Keepalive, "interval", 0.1)
+    monkeypatch.setattr(Keepalive, "timeout", 0.5)
+    keepalive = Keepalive()
+    keepalive.add(handler)
+    peer.settimeout(2)
+    assert peer.recv(5) == struct.pack("<IB", 0, 0)
+    received = b""
+    while True:
+        data = peer.recv(1024)
+        if not data:
+            break
+        received += data
+    assert received == struct.pack("<IB", 0, 0) * (len(received) // 5)
+    assert time.monotonic() - handler.last_received >= 0.5
+
+
+def packets(count):
+    return [(3, bytes([number]) * number) for number in range(0, count)]
+
+
+def encoded(packets):
+    return b"".join(
+        struct.pack("<IB", len(data), channel) + data for channel, data in packets
+    )
+
+
+def receive(peer, size):
+    peer.settimeout(2)
+    data = b""
+    while len(data) < size:
+        data += peer.recv(size - len(data))
+    return data
+
+
+def test_send(pair):
+    (handler, peer) = pair
+    for channel, data in packets(5):
+        handler.send(channel, data)
+    expected = encoded(packets(5))
+    assert receive(peer, len(expected)) == expected
+    stats = handler.send_stats()
+    assert (stats["frames"], stats["bytes"]) == (5, len(expected))
+    if handler.vectored:
+        assert (stats["syscalls"], stats["frames_per_syscall"]) == (5, 1.0)
+
+
+def test_send_unvectored(pair):
+    (handler, peer) = pair
+    handler.vectored = False
+    handler.wfile = handler.request.makefile("wb", buffering=0)
+    for channel, data in packets(3):
+        handler.send(channel, data)
+    expected = encoded(packets(3))
+    assert receive(peer, len(expected)) == expected
+    assert handler.send_stats()["syscalls"] == 6
+    assert handler.send_stats()["frames_per_syscall"] == 0.5
+
+
+def test_send_partially_taken(pair):
+    (handler, peer) = pair
+    handler.request = Trickle(handler.request)
+    for channel, data in packets(4):
+        handler.send(channel, data)
+    expected = encoded(packets(4))
+    assert receive(peer, len(expected)) == expected
+    sizes = [5 + len(data) for _, data in packets(4)]
+    assert handler.sent["syscalls"] == sum((size + 1) // 2 for size in sizes)
+
+
+@pytest.mark.parametrize("max_buffers, syscalls", [(512, 1), (4, 5), (3, 7)])
+def test_send_coalesced(monkeypatch, max_buffers, syscalls):
+    monkeypatch.setattr(Handler, "coalesce_window", 0.2)
+    monkeypatch.setattr(Handler, "max_buffers", max_buffers)
+    (ours, peer) = socket.socketpair()
+    handler = Handler(ours)
+    for channel, data in packets(10):
+        handler.send(channel, data)
+    assert handler.sent["syscalls"] == 0
+    expected = encoded(packets(10))
+    assert receive(peer, len(expected)) == expected
+    handler.close_send()  # waits for the Coalesce thread
+    stats = handler.send_stats()
+    assert (stats["frames"], stats["syscalls"]) == (10, syscalls)
+    assert stats["frames_per_syscall"] == 10 / syscalls
+    ours.close()
+    peer.close()
+
+
+def test_flush_without_flusher(monkeypatch):
+    monkeypatch.setattr(Handler, "coalesce_window", 10.0)
+    (ours, peer) = socket.socketpair()
+    handler = Handler(ours, flusher=False)
+    for channel, data in packets(3):
+        handler.send(channel, data)
+    handler.flush()
+    expected = encoded(packets(3))
+    assert receive(peer, len(expected)) == expected
+    assert handler.sent["syscalls"] == 1
+    ours.close()
+    peer.close()
+
+
+def test_async_commands_leave_the_event_loop():
+    port = free_port()
+    model = Model()
+    received = []
+    done = threading.Event()
+
+    def listen_command(_type, args):
+        received.append((_type, threading.current_thread().name))
+        if len(received) == 3:
+            done.set()
+
+    model.register("command", listen_command)
+    server = ServerThread(model, lambda model: AsyncTCPServer(model, port=port))
+    server.start()
+    try:
+        for _ in range(0, 50):
+            try:
+                sock = socket.create_connection(("127.0.0.1", port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        with sock:
+            for _type in range(0, 3):
+                data = json.dumps({"type": _type, "args": []}).encode()
+                sock.sendall(struct.pack("<IB", len(data), 5) + data)
+            assert done.wait(5)
+    finally:
+        server.stop()
+    assert [_type for _type, _ in received] == [0, 1, 2]
+    assert all(name.startswith("Command") for _, name in received)